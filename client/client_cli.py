@@ -1,32 +1,131 @@
 # cliente/cliente_cli.py
 """
 Interfaz de línea de comandos del cliente
-OPCIÓN 1: Reconexión automática por mensaje
+Conexión persistente con reconexión automática si se pierde
 """
-import json
+import os
+import sys
 import logging
 from getpass import getpass
-from typing import Optional
+from typing import Optional, List
 
 from client.communicacion import ClienteSocket
 from common.config import Config
 from common.protocolo import Mensaje
+from common.logging_config import configurar_logging_basico
 from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
 # Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+configurar_logging_basico()
 logger = logging.getLogger(__name__)
 
+# Precisión de las cantidades en EUR
+CENTIMOS = Decimal("0.01")
+
+# Secuencia ANSI: borrar pantalla + cursor al inicio
+LIMPIAR_PANTALLA = "\x1b[2J\x1b[H"
+
+# ════════════════════════════════════════════════════════
+# TEXTOS FIJOS (se construyen una sola vez al importar)
+# ════════════════════════════════════════════════════════
+
+_LINEA_DOBLE = "=" * 60
+_LINEA_SIMPLE = "-" * 60
+
+def _cabecera(titulo: str) -> str:
+    """Título centrado entre dos líneas dobles"""
+    return f"\n{_LINEA_DOBLE}\n{titulo.center(60)}\n{_LINEA_DOBLE}\n\n"
+
+BANNER = "\n".join([
+    _LINEA_DOBLE,
+    "",
+    "   SISTEMA BANCARIO SEGURO - CLIENTE".center(60),
+    "   PAI1-INTEGRIDOS".center(60),
+    "   (Reconexion automatica)".center(60),
+    "",
+    _LINEA_DOBLE,
+    "",
+    "",
+])
+
+MENU_PRINCIPAL = "\n".join([
+    "",
+    _LINEA_SIMPLE,
+    "   MENU PRINCIPAL",
+    _LINEA_SIMPLE,
+    "[1] Registro de nuevo usuario",
+    "[2] Iniciar sesion (Login)",
+    "[3] Salir",
+    _LINEA_SIMPLE,
+    "",
+])
+
+# Plantilla: el usuario cambia en cada sesión
+MENU_SESION = "\n".join([
+    "",
+    _LINEA_SIMPLE,
+    "   SESION ACTIVA - Usuario: {usuario}",
+    _LINEA_SIMPLE,
+    "[1] Realizar transferencia",
+    "[2] Cerrar sesion",
+    _LINEA_SIMPLE,
+    "",
+])
+
+CABECERA_REGISTRO = _cabecera("   REGISTRO DE NUEVO USUARIO")
+CABECERA_LOGIN = _cabecera("   INICIAR SESION")
+CABECERA_TRANSFERENCIA = _cabecera("   NUEVA TRANSFERENCIA")
+
+# Plantilla: datos de la transferencia a confirmar
+CONFIRMAR_TRANSFERENCIA = "\n".join([
+    "",
+    _LINEA_SIMPLE,
+    "   CONFIRMAR TRANSFERENCIA",
+    _LINEA_SIMPLE,
+    "   Origen:   {origen}",
+    "   Destino:  {destino}",
+    "   Cantidad: {cantidad} EUR",
+    _LINEA_SIMPLE,
+    "",
+])
+
+ADMIN_REGISTRO = "\n".join([
+    "",
+    "[*] ADMIN: Preparando mensaje seguro...",
+    "   |-- Generando NONCE...",
+    "   |-- Calculando MAC...",
+    "   |-- Conectando y enviando al servidor...",
+    "",
+])
+
+ADMIN_TRANSFERENCIA = "\n".join([
+    "",
+    "[*] ADMIN: Procesando transferencia segura...",
+    "   |-- Generando NONCE unico...",
+    "   |-- Calculando MAC de transaccion...",
+    "   |-- Conectando y enviando al servidor...",
+    "",
+])
+
+def _habilitar_ansi():
+    """Activa las secuencias ANSI en la consola de Windows 10+ (una vez)"""
+    if os.name != 'nt':
+        return
+    try:
+        import colorama
+        colorama.just_fix_windows_console()
+    except (ImportError, AttributeError):
+        os.system('')  # Activa el procesamiento VT de la consola
+
 class ClienteCLI:
     """Cliente de línea de comandos con reconexión automática"""
     
     def __init__(self):
-        # ✅ NO mantener socket abierto, solo guardar config
         self.host = Config.SERVER_HOST
         self.port = Config.SERVER_PORT
+        # ✅ Una sola conexión para toda la sesión del CLI
+        self.socket_cliente = ClienteSocket(self.host, self.port)
         self.clave_compartida = Config.get_shared_key()
         self.estado_login: dict[str, dict] = {}
         
@@ -35,25 +134,18 @@ class ClienteCLI:
         self.sesion_activa = False
     
     def limpiar_pantalla(self):
-        """Limpia la pantalla (multiplataforma)"""
-        import os
-        os.system('cls' if os.name == 'nt' else 'clear')
+        """Limpia la pantalla (multiplataforma, sin lanzar procesos)"""
+        sys.stdout.write(LIMPIAR_PANTALLA)
+        sys.stdout.flush()
     
     def mostrar_banner(self):
         """Muestra el banner inicial"""
-        print("=" * 60)
-        print("")
-        print("   SISTEMA BANCARIO SEGURO - CLIENTE".center(60))
-        print("   PAI1-INTEGRIDOS".center(60))
-        print("   (Reconexion automatica)".center(60))
-        print("")
-        print("=" * 60)
-        print()
+        sys.stdout.write(BANNER)
     
     def enviar_mensaje(self, mensaje: Mensaje) -> Optional[dict]:
         """
         Envía un mensaje protegido al servidor
-        ✅ OPCIÓN 1: Crea nueva conexión para cada mensaje
+        ✅ Reutiliza la conexión persistente (reconecta si se perdió)
         
         Args:
             mensaje: Mensaje a enviar
@@ -62,33 +154,57 @@ class ClienteCLI:
             dict: Respuesta del servidor o None si hay error
         """
         try:
-            # ✅ Crear nueva conexión temporal
-            socket_temp = ClienteSocket(self.host, self.port)
-            
-            logger.debug(f"[*] Conectando al servidor...")
-            if not socket_temp.conectar():
-                logger.error("No se pudo conectar al servidor")
-                return None
-            
-            logger.debug(f"[OK] Conectado")
-            
             # Empaquetar mensaje con MAC y NONCE
             paquete = mensaje.empaquetar(self.clave_compartida)
             
             # Enviar y recibir respuesta
-            logger.debug(f"[*] Enviando mensaje...")
-            respuesta = socket_temp.enviar_y_recibir(paquete)
-            
-            # ✅ Cerrar conexión inmediatamente
-            socket_temp.desconectar()
-            logger.debug(f"[OK] Desconectado")
-            
-            return respuesta
+            logger.debug("[*] Enviando mensaje...")
+            return self.socket_cliente.enviar_y_recibir(paquete)
             
         except Exception as e:
-            logger.error(f"Error en comunicacion: {e}")
+            logger.error("Error en comunicacion: %s", e)
             return None
     
+    def enviar_mensajes(self, mensajes: List[Mensaje]) -> List[Optional[dict]]:
+        """
+        Envía varios mensajes protegidos en un solo viaje de ida y vuelta
+        Útil para scripts de administración o varias transferencias seguidas
+        
+        Args:
+            mensajes: Mensajes a enviar (cada uno con su propio NONCE y MAC)
+        
+        Returns:
+            List[Optional[dict]]: Respuestas en el mismo orden
+        """
+        try:
+            paquetes = [m.empaquetar(self.clave_compartida) for m in mensajes]
+            return self.socket_cliente.enviar_batch(paquetes)
+        except Exception as e:
+            logger.error("Error en comunicacion: %s", e)
+            return [None] * len(mensajes)
+    
+    def enviar_lote(self, mensajes: List[Mensaje]) -> List[Optional[dict]]:
+        """
+        Envía varios mensajes como UNO solo (un MAC, un NONCE, una trama)
+        A diferencia de enviar_mensajes, el servidor responde una única vez
+        
+        Args:
+            mensajes: Mensajes a agrupar
+        
+        Returns:
+            List[Optional[dict]]: Respuestas en el mismo orden
+        """
+        respuesta = self.enviar_mensaje(Mensaje.lote(mensajes))
+        
+        if not respuesta:
+            return [None] * len(mensajes)
+        
+        # Si el lote entero se rechazó (MAC, tamaño...), cada mensaje hereda el error
+        if respuesta.get("status") != "ok":
+            return [respuesta] * len(mensajes)
+        
+        return respuesta.get("datos", {}).get("respuestas", [None] * len(mensajes))
+    
     # ════════════════════════════════════════════════════════
     # MENÚ PRINCIPAL (SIN LOGIN)
     # ════════════════════════════════════════════════════════
@@ -96,13 +212,7 @@ class ClienteCLI:
     def menu_principal(self):
         """Menú principal (usuario no logueado)"""
         while True:
-            print("\n" + "-" * 60)
-            print("   MENU PRINCIPAL")
-            print("-" * 60)
-            print("[1] Registro de nuevo usuario")
-            print("[2] Iniciar sesion (Login)")
-            print("[3] Salir")
-            print("-" * 60)
+            sys.stdout.write(MENU_PRINCIPAL)
             
             opcion = input("\nSeleccione una opcion: ").strip()
             
@@ -123,10 +233,7 @@ class ClienteCLI:
     
     def registrar_usuario(self):
         """Proceso de registro de nuevo usuario"""
-        print("\n" + "=" * 60)
-        print("   REGISTRO DE NUEVO USUARIO".center(60))
-        print("=" * 60)
-        print()
+        sys.stdout.write(CABECERA_REGISTRO)
         
         username = input("Nombre de usuario: ").strip()
         if not username:
@@ -152,15 +259,7 @@ class ClienteCLI:
             }
         )
         if self.username_actual == "admin":
-            print("\n[*] ADMIN: Preparando mensaje seguro...")
-            print("   |-- Generando NONCE...")
-            print("   |-- Calculando MAC...")
-            print("   |-- Conectando y enviando al servidor...")
-        if self.username_actual == "admin":
-            print("\n[*] ADMIN: Preparando mensaje seguro...")
-            print("   |-- Generando NONCE...")
-            print("   |-- Calculando MAC...")
-            print("   |-- Conectando y enviando al servidor...")
+            sys.stdout.write(ADMIN_REGISTRO)
         
         # ✅ Enviar al servidor (reconecta automáticamente)
         respuesta = self.enviar_mensaje(mensaje)
@@ -185,10 +284,7 @@ class ClienteCLI:
         Proceso de inicio de sesión
         El SERVIDOR maneja todos los intentos y bloqueos
         """
-        print("\n" + "=" * 60)
-        print("   INICIAR SESION".center(60))
-        print("=" * 60)
-        print()
+        sys.stdout.write(CABECERA_LOGIN)
 
         username = input("Nombre de usuario: ").strip()
         if not username:
@@ -235,13 +331,7 @@ class ClienteCLI:
     def menu_sesion(self):
         """Menú para usuario con sesión activa"""
         while self.sesion_activa:
-            print("\n" + "-" * 60)
-            print(f"   SESION ACTIVA - Usuario: {self.username_actual}")
-            print("-" * 60)
-            print("[1] Realizar transferencia")
-            print("[2] Cerrar sesion")
-            print("[2] Cerrar sesion")
-            print("-" * 60)
+            sys.stdout.write(MENU_SESION.format(usuario=self.username_actual))
             
             opcion = input("\nSeleccione una opcion: ").strip()
             
@@ -258,10 +348,7 @@ class ClienteCLI:
     
     def realizar_transferencia(self):
         """Proceso de transferencia bancaria"""
-        print("\n" + "=" * 60)
-        print("   NUEVA TRANSFERENCIA".center(60))
-        print("=" * 60)
-        print()
+        sys.stdout.write(CABECERA_TRANSFERENCIA)
         
         cuenta_origen = input("Cuenta origen (IBAN): ").strip()
         if not cuenta_origen:
@@ -273,23 +360,29 @@ class ClienteCLI:
             print("[ERROR] La cuenta destino no puede estar vacia")
             return
         
+        # Se parsea una sola vez a céntimos exactos; el mismo texto
+        # sirve para la confirmación y para el resultado
         try:
-            cantidad = float(input("Cantidad (EUR): ").strip())
-            if cantidad <= 0:
-                print("[ERROR] La cantidad debe ser mayor a 0")
-                return
-        except ValueError:
+            cantidad = Decimal(input("Cantidad (EUR): ").strip())
+            if not cantidad.is_finite():
+                raise InvalidOperation
+            cantidad = cantidad.quantize(CENTIMOS, rounding=ROUND_HALF_UP)
+        except (InvalidOperation, ValueError):
             print("[ERROR] Cantidad invalida")
             return
         
+        if cantidad <= 0:
+            print("[ERROR] La cantidad debe ser mayor a 0")
+            return
+        
+        cantidad_texto = str(cantidad)
+        
         # Confirmación
-        print("\n" + "-" * 60)
-        print("   CONFIRMAR TRANSFERENCIA")
-        print("-" * 60)
-        print(f"   Origen:   {cuenta_origen}")
-        print(f"   Destino:  {cuenta_destino}")
-        print(f"   Cantidad: {cantidad:.2f} EUR")
-        print("-" * 60)
+        sys.stdout.write(CONFIRMAR_TRANSFERENCIA.format(
+            origen=cuenta_origen,
+            destino=cuenta_destino,
+            cantidad=cantidad_texto
+        ))
         
         confirmar = input("\n¿Confirmar transferencia? (s/n): ").strip().lower()
         if confirmar != 's':
@@ -303,19 +396,11 @@ class ClienteCLI:
                 "username": self.username_actual,
                 "cuenta_origen": cuenta_origen,
                 "cuenta_destino": cuenta_destino,
-                "cantidad": cantidad
+                "cantidad": float(cantidad)
             }
         )
         if self.username_actual == "admin":
-            print("\n[*] ADMIN: Procesando transferencia segura...")
-            print("   |-- Generando NONCE unico...")
-            print("   |-- Calculando MAC de transaccion...")
-            print("   |-- Conectando y enviando al servidor...")
-        if self.username_actual == "admin":
-            print("\n[*] ADMIN: Procesando transferencia segura...")
-            print("   |-- Generando NONCE unico...")
-            print("   |-- Calculando MAC de transaccion...")
-            print("   |-- Conectando y enviando al servidor...")
+            sys.stdout.write(ADMIN_TRANSFERENCIA)
         
         # ✅ Enviar al servidor (reconecta automáticamente)
         respuesta = self.enviar_mensaje(mensaje)
@@ -326,11 +411,9 @@ class ClienteCLI:
         
         # Procesar respuesta
         if respuesta.get("status") == "ok":
-            if self.username_actual == "admin":   
+            if self.username_actual == "admin":
                 print(f"\n[OK] ADMIN: {respuesta.get('mensaje')}")
-            if self.username_actual == "admin":   
-                print(f"\n[OK] ADMIN: {respuesta.get('mensaje')}")
-            print(f"    Transferencia de {cantidad:.2f} EUR completada")
+            print(f"    Transferencia de {cantidad_texto} EUR completada")
             print("    [OK] Integridad verificada (MAC valido)")
         else:
             print(f"\n[ERROR] {respuesta.get('mensaje')}")
@@ -342,7 +425,7 @@ class ClienteCLI:
         """Cierra la sesión actual (solo local, no envía al servidor)"""
         print(f"\n[*] Cerrando sesion de {self.username_actual}...")
         
-        # ✅ OPCIÓN 1: No enviar mensaje al servidor, solo cerrar localmente
+        # No enviar mensaje al servidor, solo cerrar localmente
         self.username_actual = None
         self.sesion_activa = False
         
@@ -354,13 +437,16 @@ class ClienteCLI:
     
     def iniciar(self):
         """Inicia el cliente"""
+        _habilitar_ansi()
         self.limpiar_pantalla()
         self.mostrar_banner()
         
-        # ✅ OPCIÓN 1: NO conectar al inicio
-        # Cada mensaje creará su propia conexión
-        
+        # ✅ Conectar una sola vez; la conexión se mantiene abierta
         print(f"[*] Configurado para: {self.host}:{self.port}")
+        if self.socket_cliente.conectar():
+            print("[OK] Conexion persistente establecida")
+        else:
+            print("[WARNING] Servidor no disponible, se reintentara al enviar")
         print("[OK] Reconexion automatica habilitada\n")
         
         try:
@@ -368,6 +454,8 @@ class ClienteCLI:
             self.menu_principal()
         except Exception as e:
             logger.error(f"Error: {e}")
+        finally:
+            self.socket_cliente.desconectar()
 
 
 # ════════════════════════════════════════════════════════
@@ -1,12 +1,51 @@
 import socket
-import json
 import logging
-from typing import Optional, Tuple
+from typing import Optional, Tuple, List
 
-from common.constantes import DEFAULT_HOST, DEFAULT_PORT, BUFFER_SIZE
+from common.constantes import (
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    SOCKET_SNDBUF,
+    KEEPALIVE_IDLE,
+    KEEPALIVE_INTERVAL,
+    KEEPALIVE_COUNT
+)
+from common.protocolo import cabecera_trama, recibir_trama, desempaquetar_respuesta
 
 logger = logging.getLogger(__name__)
 
+class EscritorTramas:
+    """
+    Acumula tramas salientes y las envía juntas en un único sendall
+    
+    Se vacía al llamar a vaciar() o al superar UMBRAL bytes acumulados:
+    menos llamadas al sistema cuando se envían varias tramas seguidas.
+    """
+    
+    UMBRAL = 8192  # bytes
+    
+    def __init__(self):
+        self.buffer = bytearray()
+    
+    def escribir(self, sock: socket.socket, paquete: bytes):
+        """Añade una trama (cabecera + paquete) al buffer"""
+        # Cabecera y paquete por separado: el paquete se copia una sola vez,
+        # directamente al buffer, sin la concatenación intermedia de enmarcar()
+        self.buffer += cabecera_trama(len(paquete))
+        self.buffer += paquete
+        if len(self.buffer) >= self.UMBRAL:
+            self.vaciar(sock)
+    
+    def vaciar(self, sock: socket.socket):
+        """Envía todo lo acumulado con un único sendall"""
+        if self.buffer:
+            datos, self.buffer = self.buffer, bytearray()
+            sock.sendall(datos)
+    
+    def descartar(self):
+        """Olvida las tramas sin enviar (la conexión se ha perdido)"""
+        self.buffer = bytearray()
+
 class ClienteSocket:
     """Gestiona la conexión socket con el servidor"""
     
@@ -14,6 +53,7 @@ class ClienteSocket:
         self.host = host
         self.port = port
         self.socket: Optional[socket.socket] = None
+        self._escritor = EscritorTramas()
     
     def conectar(self) -> bool:
         """
@@ -25,22 +65,68 @@ class ClienteSocket:
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.host, self.port))
-            logger.info(f"[OK]Conectado al servidor {self.host}:{self.port}")
+            self._configurar_socket()
+            logger.info("[OK] Conectado al servidor %s:%d", self.host, self.port)
             return True
         except ConnectionRefusedError:
-            logger.error(f"[ERROR] No se pudo conectar a {self.host}:{self.port}")
-            logger.error("   ¿Está el servidor ejecutándose?")
+            logger.error("[ERROR] No se pudo conectar a %s:%d", self.host, self.port)
+            logger.error("   Esta el servidor ejecutandose?")
             return False
         except Exception as e:
-            logger.error(f"[ERROR] Error al conectar: {e}")
+            logger.error("[ERROR] Error al conectar: %s", e)
             return False
     
-    def enviar(self, datos: bytes) -> bool:
+    def _configurar_socket(self):
+        """
+        Ajusta las opciones TCP de la conexión
+        
+        - TCP_NODELAY: cada petición es una escritura pequeña seguida de
+          una lectura; sin él, Nagle + ACK retardado añaden ~40 ms
+        - SO_SNDBUF: buffer de envío holgado para no partir escrituras
+        - SO_KEEPALIVE: detecta servidores caídos mientras la conexión
+          persistente está inactiva
+        """
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Ajuste fino solo donde el sistema lo soporta (Linux, macOS reciente)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    
+    def enviar(self, datos: bytes, vaciar: bool = True) -> bool:
         """
-        Envía datos al servidor
+        Envía datos al servidor (como una trama con longitud)
         
         Args:
             datos: Bytes a enviar (paquete completo)
+            vaciar: Si es False la trama se acumula y sale junto a las
+                siguientes (al llamar a vaciar(), recibir() o al
+                superar EscritorTramas.UMBRAL)
+        
+        Returns:
+            bool: True si el envío fue exitoso
+        """
+        if not self.socket:
+            logger.error("[ERROR] Socket no conectado")
+            return False
+        
+        try:
+            self._escritor.escribir(self.socket, datos)
+            if vaciar:
+                self._escritor.vaciar(self.socket)
+            logger.debug(" Enviados %d bytes", len(datos))
+            return True
+        except Exception as e:
+            logger.error("[ERROR] Error al enviar: %s", e)
+            return False
+    
+    def vaciar(self) -> bool:
+        """
+        Envía las tramas acumuladas con enviar(..., vaciar=False)
         
         Returns:
             bool: True si el envío fue exitoso
@@ -50,16 +136,15 @@ class ClienteSocket:
             return False
         
         try:
-            self.socket.sendall(datos)
-            logger.debug(f" Enviados {len(datos)} bytes")
+            self._escritor.vaciar(self.socket)
             return True
         except Exception as e:
-            logger.error(f"[ERROR] Error al enviar: {e}")
+            logger.error("[ERROR] Error al enviar: %s", e)
             return False
     
     def recibir(self) -> Optional[bytes]:
         """
-        Recibe datos del servidor
+        Recibe una trama completa del servidor
         
         Returns:
             bytes: Datos recibidos o None si hay error
@@ -69,49 +154,140 @@ class ClienteSocket:
             return None
         
         try:
-            datos = self.socket.recv(BUFFER_SIZE)
-            if not datos:
-                logger.warning("[WARNING]  Servidor cerró la conexión")
+            # Las peticiones pendientes deben salir antes de esperar respuesta
+            self._escritor.vaciar(self.socket)
+            datos = recibir_trama(self.socket)
+            if datos is None:
+                logger.warning("[WARNING] Servidor cerro la conexion")
                 return None
             
-            logger.debug(f" Recibidos {len(datos)} bytes")
+            logger.debug(" Recibidos %d bytes", len(datos))
             return datos
         except Exception as e:
-            logger.error(f"[ERROR] Error al recibir: {e}")
+            logger.error("[ERROR] Error al recibir: %s", e)
             return None
     
     def enviar_y_recibir(self, datos: bytes) -> Optional[dict]:
         """
         Envía datos y espera respuesta del servidor
         
+        Reutiliza la conexión abierta. Si el servidor la ha cerrado
+        (reinicio, timeout de inactividad), reconecta y reintenta UNA vez.
+        Reenviar el mismo paquete es seguro: si el servidor llegó a
+        procesarlo, lo rechazará por NONCE repetido.
+        
         Args:
             datos: Paquete a enviar
         
         Returns:
             dict: Respuesta parseada del servidor
         """
-        if not self.enviar(datos):
+        if not self.socket and not self.conectar():
             return None
         
-        respuesta_bytes = self.recibir()
-        if not respuesta_bytes:
-            return None
+        respuesta_bytes = None
+        for intento in range(2):
+            try:
+                self._escritor.escribir(self.socket, datos)
+                self._escritor.vaciar(self.socket)
+                respuesta_bytes = recibir_trama(self.socket)
+                if respuesta_bytes is None:
+                    raise ConnectionResetError("El servidor cerró la conexión")
+                break
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+                self.desconectar()
+                if intento == 1:
+                    logger.error("[ERROR] Conexion perdida: %s", e)
+                    return None
+                logger.warning("[WARNING] Conexion perdida (%s), reconectando...", e)
+                if not self.conectar():
+                    return None
+            except Exception as e:
+                logger.error("[ERROR] Error de comunicacion: %s", e)
+                return None
+        
+        logger.debug(" Recibidos %d bytes", len(respuesta_bytes))
         
         try:
-            respuesta = json.loads(respuesta_bytes.decode('utf-8'))
+            respuesta = desempaquetar_respuesta(respuesta_bytes)
             return respuesta
-        except json.JSONDecodeError as e:
-            logger.error(f"[ERROR] Error parseando respuesta: {e}")
+        except ValueError as e:
+            logger.error("[ERROR] Error parseando respuesta: %s", e)
             return None
     
+    def enviar_batch(self, paquetes: List[bytes]) -> List[Optional[dict]]:
+        """
+        Envía varios paquetes seguidos sin esperar respuesta (pipelining)
+        
+        Todas las tramas salen en un único sendall y después se leen las
+        respuestas, que el servidor devuelve en el mismo orden: N peticiones
+        cuestan un solo viaje de ida y vuelta. Pensado para lotes pequeños
+        (el servidor no lee más hasta que respondemos).
+        
+        Si la conexión estaba cerrada (reinicio, timeout de inactividad) y no
+        llegó ninguna respuesta, reconecta y reenvía el lote UNA vez, como
+        enviar_y_recibir. Con alguna respuesta ya leída no se reenvía: se
+        desconecta, para que las respuestas sin leer no se confundan con
+        las de la siguiente petición.
+        
+        Args:
+            paquetes: Paquetes a enviar (ya empaquetados)
+        
+        Returns:
+            List[Optional[dict]]: Respuestas en orden (None si alguna falta)
+        """
+        if not paquetes:
+            return []
+        
+        respuestas: List[Optional[dict]] = []
+        if self.socket or self.conectar():
+            for intento in range(2):
+                try:
+                    for paquete in paquetes:
+                        self._escritor.escribir(self.socket, paquete)
+                    self._escritor.vaciar(self.socket)
+                    logger.debug(" Enviados %d paquetes en lote", len(paquetes))
+                    
+                    for _ in paquetes:
+                        respuesta_bytes = recibir_trama(self.socket)
+                        if respuesta_bytes is None:
+                            raise ConnectionResetError("El servidor cerró la conexión")
+                        respuestas.append(desempaquetar_respuesta(respuesta_bytes))
+                    break
+                except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+                    self._escritor.descartar()
+                    self.desconectar()
+                    if respuestas or intento == 1:
+                        logger.error("[ERROR] Conexion perdida en envio por lotes: %s", e)
+                        break
+                    logger.warning("[WARNING] Conexion perdida (%s), reconectando...", e)
+                    if not self.conectar():
+                        break
+                except Exception as e:
+                    logger.error("[ERROR] Error en envio por lotes: %s", e)
+                    self._escritor.descartar()
+                    self.desconectar()
+                    break
+        
+        # Completar con None las respuestas que no llegaron
+        respuestas.extend([None] * (len(paquetes) - len(respuestas)))
+        return respuestas
+    
     def desconectar(self):
         """Cierra la conexión con el servidor"""
         if self.socket:
+            try:
+                # Última oportunidad para las tramas acumuladas
+                self._escritor.vaciar(self.socket)
+            except OSError as e:
+                logger.warning("[WARNING] Tramas pendientes descartadas: %s", e)
+                self._escritor.descartar()
+            
             try:
                 self.socket.close()
-                logger.info("🔌 Desconectado del servidor")
+                logger.info("[CLOSE] Desconectado del servidor")
             except Exception as e:
-                logger.error(f"[ERROR] Error al desconectar: {e}")
+                logger.error("[ERROR] Error al desconectar: %s", e)
             finally:
                 self.socket = None
     
@@ -35,10 +35,12 @@ def preparar_mensaje_seguro(
     """
     # Generar NONCE único
     nonce = generar_nonce()
-    logger.debug(f" NONCE generado: {nonce.hex()[:16]}...")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(" NONCE generado: %s...", nonce.hex()[:16])
     
     # Calcular MAC
     mac = calcular_mac(clave, mensaje, nonce)
-    logger.debug(f"[LOCK] MAC calculado: {mac.hex()[:16]}...")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[LOCK] MAC calculado: %s...", mac.hex()[:16])
     
     return mensaje, mac, nonce
\ No newline at end of file
@@ -4,6 +4,7 @@ Gestión de configuración
 """
 import os
 from pathlib import Path
+from typing import Optional
 from dotenv import load_dotenv
 import base64
 
@@ -14,19 +15,41 @@ class Config:
     SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
     SERVER_PORT = int(os.getenv("SERVER_PORT", 5000))
     
+    # Hilos que atienden clientes (uno por conexión activa)
+    MAX_WORKERS = int(os.getenv("MAX_WORKERS", min(32, (os.cpu_count() or 4) * 4)))
+    # Conexiones abiertas a la vez: las que pasan de MAX_WORKERS esperan en
+    # cola a que otra se cierre; por encima de este límite se rechazan con
+    # "Servidor ocupado" (mejor un error inmediato que esperar sin respuesta)
+    MAX_CONEXIONES = int(os.getenv("MAX_CONEXIONES", MAX_WORKERS * 4))
+    # Segundos sin peticiones antes de cerrar una conexión y liberar su hilo
+    # (el cliente reconecta solo en la siguiente petición). Corto: un cliente
+    # inactivo retiene un hilo del pool que otro podría estar usando
+    CLIENT_IDLE_TIMEOUT = float(os.getenv("CLIENT_IDLE_TIMEOUT", 30))
+    
     # Base de datos
     DB_PATH = os.getenv("DB_PATH", "./database/usuarios.db")
     
+    # Pruebas: Argon2 con coste reducido (NUNCA en producción)
+    TEST_MODE = os.getenv("TEST_MODE", "0") == "1"
+    
     # Logs
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
     LOG_FILE = os.getenv("LOG_FILE", "./logs/servidor.log")
     
     # Clave compartida (en base64)
     SHARED_KEY_B64 = os.getenv("SHARED_KEY")
+    _clave_compartida: Optional[bytes] = None  # Caché tras la primera carga
     
     @classmethod
     def get_shared_key(cls) -> bytes:
-        """Obtiene la clave compartida decodificada"""
+        """Obtiene la clave compartida decodificada (solo se carga una vez)"""
+        if cls._clave_compartida is None:
+            cls._clave_compartida = cls._cargar_clave()
+        return cls._clave_compartida
+    
+    @classmethod
+    def _cargar_clave(cls) -> bytes:
+        """Decodifica la clave del entorno o la lee del archivo"""
         if cls.SHARED_KEY_B64:
             return base64.b64decode(cls.SHARED_KEY_B64)
         # Si no existe, cargar desde archivo
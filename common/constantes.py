@@ -10,20 +10,57 @@ KEY_SIZE = 32  # bytes (256 bits para HMAC)
 
 # Algoritmos
 HASH_ALGORITHM = "sha256"
-MAC_ALGORITHM = "HMAC-SHA256"
+MAC_HMAC_SHA256 = "HMAC-SHA256"
+MAC_BLAKE2B = "BLAKE2b-256"  # MAC con clave nativo, un solo pase (~2.5x más rápido)
+MAC_ALGORITHM = MAC_HMAC_SHA256  # Cliente y servidor deben usar el mismo
 PASSWORD_HASHER = "Argon2id"
 
-# Argon2 parámetros
+# Argon2 parámetros (t=3, m=64 MB, p=4: ~170 ms por hash en un núcleo actual)
 ARGON2_TIME_COST = 3  # iteraciones
 ARGON2_MEMORY_COST = 65536  # 64 MB
 ARGON2_PARALLELISM = 4  # hilos
 ARGON2_HASH_LEN = 32  # bytes
 ARGON2_SALT_LEN = 16  # bytes
+# Coste aceptable por hash medido al arrancar; fuera de rango se avisa
+ARGON2_TIEMPO_MIN_MS = 50  # por debajo, demasiado barato contra fuerza bruta
+ARGON2_TIEMPO_MAX_MS = 1000  # por encima, bloquea demasiado cada login
+# Coste reducido solo para tests (Config.TEST_MODE): ~1 ms por hash
+ARGON2_TEST_TIME_COST = 1
+ARGON2_TEST_MEMORY_COST = 4096  # 4 MB
+ARGON2_TEST_PARALLELISM = 1
+
+# Caché de logins verificados (evita repetir Argon2 en logins seguidos)
+CACHE_LOGIN_TTL = 60  # segundos que un login correcto vale sin Argon2
+CACHE_LOGIN_MAX = 1024  # usuarios en caché (LRU)
 
 # Configuración de red
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = 5000
 BUFFER_SIZE = 4096
+SOCKET_SNDBUF = 64 * 1024  # bytes (evita escrituras parciales)
+
+# Tramas: [longitud u32 big-endian][paquete]
+FRAME_HEADER_SIZE = 4  # bytes
+MAX_FRAME_SIZE = 1024 * 1024  # 1 MB (rechaza cabeceras corruptas)
+
+# Lotes: varias operaciones bajo un único MAC/NONCE
+MAX_ITEMS_LOTE = 100
+# Registros/logins por lote: cada uno cuesta un hash Argon2 (~170 ms), así
+# un solo paquete no retiene un hilo del servidor durante segundos
+MAX_ARGON2_LOTE = 5
+
+# Limpieza de NONCEs caducados (hilo en segundo plano del servidor)
+INTERVALO_LIMPIEZA_NONCES = 60  # segundos entre pasadas
+LOTE_LIMPIEZA_NONCES = 10_000  # filas por DELETE (acota el bloqueo de escritura)
+
+# Keep-alive TCP (conexión persistente cliente-servidor)
+KEEPALIVE_IDLE = 60  # segundos sin tráfico antes de sondear
+KEEPALIVE_INTERVAL = 10  # segundos entre sondas
+KEEPALIVE_COUNT = 3  # sondas fallidas antes de dar la conexión por muerta
 
 # Mensajes
-ENCODING = "utf-8"
\ No newline at end of file
+ENCODING = "utf-8"
+
+# Formatos de serialización (primer byte de cada paquete)
+FORMATO_JSON = 1
+FORMATO_MSGPACK = 2
\ No newline at end of file
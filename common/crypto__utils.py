@@ -2,24 +2,55 @@
 """
 Utilidades criptográficas compartidas
 """
+import os
 import hmac
 import hashlib
-import secrets
 from typing import Tuple
-from .constantes import NONCE_SIZE, MAC_SIZE
+from .constantes import NONCE_SIZE, MAC_SIZE, MAC_ALGORITHM, MAC_BLAKE2B
+
+# cryptography (OpenSSL) tiene menos coste por llamada que el hmac de la stdlib
+try:
+    from cryptography.hazmat.primitives import hmac as crypto_hmac, hashes
+except ImportError:
+    crypto_hmac = None
+
+# Contextos MAC ya inicializados por clave (preparación de la clave una vez)
+# La clave compartida es fija durante todo el proceso: basta con pocas entradas
+_contextos_hmac = {}
+_MAX_CONTEXTOS = 8
+
+def _nuevo_contexto(clave: bytes):
+    """Crea el contexto del algoritmo configurado en MAC_ALGORITHM"""
+    if MAC_ALGORITHM == MAC_BLAKE2B:
+        return hashlib.blake2b(key=clave, digest_size=MAC_SIZE)
+    if crypto_hmac:
+        return crypto_hmac.HMAC(clave, hashes.SHA256())
+    return hmac.new(clave, None, hashlib.sha256)
+
+def _contexto_hmac(clave: bytes):
+    """Devuelve el contexto MAC preparado para la clave (sin datos)"""
+    contexto = _contextos_hmac.get(clave)
+    if contexto is None:
+        if len(_contextos_hmac) >= _MAX_CONTEXTOS:
+            _contextos_hmac.clear()
+        contexto = _nuevo_contexto(clave)
+        _contextos_hmac[clave] = contexto
+    return contexto
 
 def generar_nonce() -> bytes:
     """
     Genera un NONCE criptográficamente seguro
+    (os.urandom: una sola llamada al CSPRNG del sistema)
     
     Returns:
         bytes: NONCE de 32 bytes
     """
-    return secrets.token_bytes(NONCE_SIZE)
+    return os.urandom(NONCE_SIZE)
 
 def calcular_mac(clave: bytes, mensaje: bytes, nonce: bytes) -> bytes:
     """
     Calcula el MAC de un mensaje usando HMAC-SHA256
+    (o BLAKE2b con clave si MAC_ALGORITHM = MAC_BLAKE2B)
     Incluye el mensaje y el NONCE para asegurar la unicidad del MAC y evitar ataques de repetición
     Args:
         clave: Clave compartida
@@ -29,8 +60,14 @@ def calcular_mac(clave: bytes, mensaje: bytes, nonce: bytes) -> bytes:
     Returns:
         bytes: MAC de 32 bytes
     """
-    datos = mensaje + nonce
-    return hmac.new(clave, datos, hashlib.sha256).digest()
+    # copy() reutiliza la preparación de la clave; dos update() evitan
+    # concatenar mensaje + nonce
+    h = _contexto_hmac(clave).copy()
+    h.update(mensaje)
+    h.update(nonce)
+    if crypto_hmac and isinstance(h, crypto_hmac.HMAC):
+        return h.finalize()
+    return h.digest()
 
 def verificar_mac(clave: bytes, mensaje: bytes, nonce: bytes, mac_recibido: bytes) -> bool:
     """
@@ -38,7 +75,7 @@ def verificar_mac(clave: bytes, mensaje: bytes, nonce: bytes, mac_recibido: byte
     
     Args:
         clave: Clave compartida
-        mensaje: Datos recibidos
+        mensaje: Datos recibidos (bytes o memoryview sobre el paquete)
         nonce: NONCE recibido
         mac_recibido: MAC recibido del cliente
     
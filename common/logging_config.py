@@ -1,10 +1,63 @@
 """
 Configuración centralizada de logging
 """
+import atexit
 import logging
 import logging.handlers
+import queue
 from pathlib import Path
 from datetime import datetime
+from typing import List, Optional
+
+# Formato compartido por cliente, servidor y run_servidor
+FORMATO_BASICO = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Loggers dedicados (ver log_transaccion / log_evento_seguridad)
+LOGGER_TRANSACCIONES = "TRANSACCIONES"
+LOGGER_SEGURIDAD = "SEGURIDAD"
+
+
+class FiltroTransacciones(logging.Filter):
+    """Deja pasar solo los registros del logger de transacciones"""
+    def filter(self, record):
+        # Comparar el nombre es O(1): no formatea ni recorre el mensaje
+        return record.name == LOGGER_TRANSACCIONES
+
+
+def configurar_logging_basico(
+    nivel: int = logging.INFO,
+    handlers: Optional[List[logging.Handler]] = None,
+    en_segundo_plano: bool = False
+):
+    """
+    Configuración mínima (consola y, opcionalmente, otros handlers).
+    Si el root logger ya tiene handlers no hace nada.
+    
+    Con en_segundo_plano=True los hilos solo encolan los registros y un
+    QueueListener los formatea y escribe (fichero/consola) en su propio hilo
+    """
+    if logging.getLogger().handlers:
+        return
+    
+    if en_segundo_plano:
+        destinos = handlers or [logging.StreamHandler()]
+        formato = logging.Formatter(FORMATO_BASICO)
+        for handler in destinos:
+            handler.setFormatter(formato)
+        
+        cola = queue.SimpleQueue()
+        oyente = logging.handlers.QueueListener(cola, *destinos, respect_handler_level=True)
+        oyente.start()
+        atexit.register(oyente.stop)  # Vacía la cola al salir
+        
+        handler_cola = logging.handlers.QueueHandler(cola)
+        logging.basicConfig(level=nivel, handlers=[handler_cola])
+        # El formato completo lo aplican los destinos en el hilo del oyente
+        handler_cola.setFormatter(logging.Formatter('%(message)s'))
+        return
+    
+    logging.basicConfig(level=nivel, format=FORMATO_BASICO, handlers=handlers)
+
 
 def configurar_logging(
     nivel: str = "INFO",
@@ -49,12 +102,14 @@ def configurar_logging(
     # HANDLER 2: Archivo de seguridad (solo warnings y errors)
     # ════════════════════════════════════════════════════════
     
+    # delay=True: el fichero no se abre hasta el primer aviso
     archivo_seguridad = Path(log_dir) / "seguridad.log"
     handler_seguridad = logging.handlers.RotatingFileHandler(
         archivo_seguridad,
         maxBytes=10 * 1024 * 1024,
         backupCount=5,
-        encoding='utf-8'
+        encoding='utf-8',
+        delay=True
     )
     handler_seguridad.setLevel(logging.WARNING)
     handler_seguridad.setFormatter(formato)
@@ -66,7 +121,8 @@ def configurar_logging(
     archivo_transacciones = Path(log_dir) / "transacciones.log"
     handler_transacciones = logging.FileHandler(
         archivo_transacciones,
-        encoding='utf-8'
+        encoding='utf-8',
+        delay=True  # Solo se abre si se registra alguna transacción
     )
     handler_transacciones.setLevel(logging.INFO)
     
@@ -78,10 +134,6 @@ def configurar_logging(
     handler_transacciones.setFormatter(formato_tx)
     
     # Filtro: solo logs de transacciones
-    class FiltroTransacciones(logging.Filter):
-        def filter(self, record):
-            return 'transaccion' in record.getMessage().lower()
-    
     handler_transacciones.addFilter(FiltroTransacciones())
     
     # ════════════════════════════════════════════════════════
@@ -127,7 +179,7 @@ def log_evento_seguridad(
         origen: IP o identificador del origen
         datos_adicionales: Información adicional
     """
-    logger = logging.getLogger("SEGURIDAD")
+    logger = logging.getLogger(LOGGER_SEGURIDAD)
     
     mensaje = f"[{tipo}]"
     if origen:
@@ -159,7 +211,7 @@ def log_transaccion(
         tx_id: ID de transacción
         mac_verificado: Si el MAC fue verificado correctamente
     """
-    logger = logging.getLogger("TRANSACCIONES")
+    logger = logging.getLogger(LOGGER_TRANSACCIONES)
     
     estado_mac = "✓ MAC_OK" if mac_verificado else "✗ MAC_FAIL"
     
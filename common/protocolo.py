@@ -3,10 +3,134 @@
 Protocolo de comunicación cliente-servidor
 """
 import json
-import base64
-from typing import Dict, Any, Tuple
+import struct
+from typing import Dict, Any, Tuple, Optional, List
 from common.crypto__utils import calcular_mac, generar_nonce
-from common.constantes import ENCODING
+from common.constantes import (
+    ENCODING,
+    FRAME_HEADER_SIZE,
+    MAX_FRAME_SIZE,
+    MAC_SIZE,
+    NONCE_SIZE,
+    FORMATO_JSON,
+    FORMATO_MSGPACK
+)
+
+# msgpack es opcional: sin él se sigue hablando JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# orjson es opcional: acelera el formato JSON (trabaja directamente con bytes)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FORMATO_POR_DEFECTO = FORMATO_MSGPACK if msgpack else FORMATO_JSON
+FORMATOS_DISPONIBLES = (FORMATO_JSON, FORMATO_MSGPACK) if msgpack else (FORMATO_JSON,)
+
+# Sobre binario de cada paquete: [formato u8][mac][nonce][mensaje...]
+# MAC y NONCE tienen tamaño fijo; el mensaje ocupa el resto de la trama
+_SOBRE = struct.Struct(f'>B{MAC_SIZE}s{NONCE_SIZE}s')
+
+# ===================================================================
+# TRAMAS (TCP no conserva límites de mensaje)
+# ===================================================================
+
+# Cabecera de longitud precompilada (cliente y servidor)
+_CABECERA = struct.Struct('>I')
+
+def cabecera_trama(longitud: int) -> bytes:
+    """Cabecera de una trama: [longitud u32 big-endian]"""
+    return _CABECERA.pack(longitud)
+
+def enmarcar(paquete: bytes) -> bytes:
+    """
+    Antepone la longitud del paquete para enviarlo por el socket
+    
+    Formato: [longitud u32 big-endian][paquete]
+    """
+    return _CABECERA.pack(len(paquete)) + paquete
+
+def _recibir_exacto(sock, n: int) -> Optional[bytearray]:
+    """
+    Lee exactamente n bytes del socket (None si se cierra antes)
+    
+    El kernel escribe directamente en un único buffer del tamaño
+    exacto (recv_into), sin crear un bytes por cada recv().
+    """
+    buffer = bytearray(n)
+    vista = memoryview(buffer)
+    leidos = 0
+    while leidos < n:
+        recibidos = sock.recv_into(vista[leidos:])
+        if not recibidos:
+            return None
+        leidos += recibidos
+    return buffer
+
+def recibir_trama(sock) -> Optional[bytearray]:
+    """
+    Recibe una trama completa del socket
+    
+    Returns:
+        bytearray: Paquete sin la cabecera, o None si la conexión se cerró
+    
+    Raises:
+        ValueError: Si la cabecera anuncia una longitud no permitida
+    """
+    cabecera = _recibir_exacto(sock, FRAME_HEADER_SIZE)
+    if cabecera is None:
+        return None
+    
+    (longitud,) = _CABECERA.unpack(cabecera)
+    if longitud > MAX_FRAME_SIZE:
+        raise ValueError(f"Trama demasiado grande: {longitud} bytes")
+    
+    return _recibir_exacto(sock, longitud)
+
+# ===================================================================
+# FORMATOS DE SERIALIZACIÓN
+# ===================================================================
+
+def codificar_json(obj: Any) -> bytes:
+    """Serializa a JSON (bytes UTF-8) usando orjson si está disponible"""
+    if orjson:
+        return orjson.dumps(obj)
+    # Misma salida compacta y UTF-8 que orjson
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode(ENCODING)
+
+def decodificar_json(datos: bytes) -> Any:
+    """
+    Deserializa JSON desde bytes usando orjson si está disponible
+    
+    Raises:
+        json.JSONDecodeError: Si los datos no son JSON válido
+    """
+    if orjson:
+        return orjson.loads(datos)
+    # json.loads no admite memoryview
+    if isinstance(datos, memoryview):
+        datos = datos.tobytes()
+    return json.loads(datos)
+
+def _codificar(obj: Dict[str, Any], formato: int) -> bytes:
+    """Serializa un diccionario en el formato indicado"""
+    if formato == FORMATO_MSGPACK and msgpack:
+        return msgpack.packb(obj, use_bin_type=True)
+    if formato == FORMATO_JSON:
+        return codificar_json(obj)
+    raise ValueError(f"Formato no soportado: {formato}")
+
+def _decodificar(datos: bytes, formato: int) -> Dict[str, Any]:
+    """Deserializa un diccionario en el formato indicado"""
+    if formato == FORMATO_MSGPACK and msgpack:
+        return msgpack.unpackb(datos, raw=False)
+    if formato == FORMATO_JSON:
+        return decodificar_json(datos)
+    raise ValueError(f"Formato no soportado: {formato}")
 
 class Mensaje:
     """Representa un mensaje del protocolo"""
@@ -17,20 +141,25 @@ class Mensaje:
     TRANSACCION = "transaccion"
     LOGOUT = "logout"
     RESPUESTA = "respuesta"
+    LOTE = "lote"  # datos: {"items": [{"tipo": ..., "datos": ...}, ...]}
+    
+    # Sin __dict__ por instancia: se crea un Mensaje por petición
+    __slots__ = ("tipo", "datos")
     
     def __init__(self, tipo: str, datos: Dict[str, Any]):
         self.tipo = tipo
         self.datos = datos
     
-    def serializar(self, clave: bytes) -> Tuple[bytes, bytes, bytes]:
+    def serializar(self, clave: bytes, formato: int = FORMATO_POR_DEFECTO) -> Tuple[bytes, bytes, bytes]:
         """
         Serializa el mensaje con protección de integridad
         
         Args:
             clave: Clave compartida para MAC
+            formato: FORMATO_JSON o FORMATO_MSGPACK
         
         Returns:
-            Tuple[bytes, bytes, bytes]: (mensaje_json, mac, nonce)
+            Tuple[bytes, bytes, bytes]: (mensaje_serializado, mac, nonce)
         """
         # Crear estructura del mensaje
         mensaje_dict = {
@@ -38,59 +167,72 @@ class Mensaje:
             "datos": self.datos
         }
         
-        # Serializar a JSON
-        mensaje_json = json.dumps(mensaje_dict).encode(ENCODING)
+        # Serializar
+        mensaje_bytes = _codificar(mensaje_dict, formato)
         
         # Generar NONCE
         nonce = generar_nonce()
         
         # Calcular MAC
-        mac = calcular_mac(clave, mensaje_json, nonce)
+        mac = calcular_mac(clave, mensaje_bytes, nonce)
         
-        return mensaje_json, mac, nonce
+        return mensaje_bytes, mac, nonce
     
-    def empaquetar(self, clave: bytes) -> bytes:
+    def empaquetar(self, clave: bytes, formato: int = FORMATO_POR_DEFECTO) -> bytes:
         """
         Empaqueta el mensaje completo para envío por socket
         
-        Formato: [tamaño_mensaje][mensaje][tamaño_mac][mac][tamaño_nonce][nonce]
+        Formato: [formato u8][mac 32][nonce 32][mensaje serializado]
+        Sin base64 ni segundo nivel de JSON/msgpack alrededor.
         """
-        mensaje_json, mac, nonce = self.serializar(clave)
-        
-        # Crear paquete con tamaños
-        paquete = {
-            "mensaje": base64.b64encode(mensaje_json).decode('ascii'),
-            "mac": base64.b64encode(mac).decode('ascii'),
-            "nonce": base64.b64encode(nonce).decode('ascii')
-        }
-        
-        return json.dumps(paquete).encode(ENCODING)
+        mensaje_bytes, mac, nonce = self.serializar(clave, formato)
+        return _SOBRE.pack(formato, mac, nonce) + mensaje_bytes
     
     @staticmethod
-    def desempaquetar(paquete_bytes: bytes) -> Tuple[bytes, bytes, bytes]:
+    def desempaquetar(paquete_bytes: bytes) -> Tuple[int, memoryview, bytes, bytes]:
         """
         Desempaqueta un mensaje recibido
         
         Returns:
-            Tuple[bytes, bytes, bytes]: (mensaje, mac, nonce)
+            Tuple[int, memoryview, bytes, bytes]: (formato, mensaje, mac, nonce)
+            El mensaje es una vista sobre el paquete recibido (sin copiarlo);
+            el MAC, la comparación y los decodificadores la aceptan tal cual.
+        
+        Raises:
+            ValueError: Si el paquete es demasiado corto o el formato es desconocido
         """
-        paquete = json.loads(paquete_bytes.decode(ENCODING))
+        if len(paquete_bytes) < _SOBRE.size:
+            raise ValueError(f"Paquete demasiado corto: {len(paquete_bytes)} bytes")
         
-        mensaje = base64.b64decode(paquete["mensaje"])
-        mac = base64.b64decode(paquete["mac"])
-        nonce = base64.b64decode(paquete["nonce"])
+        formato, mac, nonce = _SOBRE.unpack_from(paquete_bytes)
+        if formato not in FORMATOS_DISPONIBLES:
+            raise ValueError(f"Formato no soportado: {formato}")
         
-        return mensaje, mac, nonce
+        return formato, memoryview(paquete_bytes)[_SOBRE.size:], mac, nonce
+    
+    @staticmethod
+    def desde_bytes(mensaje_bytes: bytes, formato: int) -> 'Mensaje':
+        """Crea un Mensaje desde sus bytes serializados"""
+        mensaje_dict = _decodificar(mensaje_bytes, formato)
+        return Mensaje(mensaje_dict["tipo"], mensaje_dict["datos"])
+    
+    @staticmethod
+    def lote(mensajes: List['Mensaje']) -> 'Mensaje':
+        """Agrupa varios mensajes en uno solo (un MAC y un NONCE para todos)"""
+        return Mensaje(Mensaje.LOTE, {
+            "items": [{"tipo": m.tipo, "datos": m.datos} for m in mensajes]
+        })
     
     @staticmethod
     def desde_json(mensaje_json: bytes) -> 'Mensaje':
         """Crea un Mensaje desde JSON"""
-        mensaje_dict = json.loads(mensaje_json.decode(ENCODING))
-        return Mensaje(mensaje_dict["tipo"], mensaje_dict["datos"])
+        return Mensaje.desde_bytes(mensaje_json, FORMATO_JSON)
 
 class MensajeRespuesta:
     """Mensaje de respuesta del servidor"""
     
+    __slots__ = ("status", "mensaje", "datos")
+    
     def __init__(self, status: str, mensaje: str, datos: Dict[str, Any] = None):
         self.status = status  # "ok" o "error"
         self.mensaje = mensaje
@@ -103,6 +245,27 @@ class MensajeRespuesta:
             "datos": self.datos
         }
     
-    def empaquetar(self) -> bytes:
+    def empaquetar(self, formato: int = FORMATO_POR_DEFECTO) -> bytes:
         """Empaqueta la respuesta (sin MAC para simplificar)"""
-        return json.dumps(self.a_dict()).encode(ENCODING)
\ No newline at end of file
+        return empaquetar_respuesta(self.a_dict(), formato)
+
+def empaquetar_respuesta(respuesta: Dict[str, Any], formato: int = FORMATO_POR_DEFECTO) -> bytes:
+    """
+    Empaqueta una respuesta del servidor
+    
+    Formato: [formato u8][respuesta serializada]
+    El servidor contesta en el mismo formato en que llegó la petición.
+    """
+    return bytes((formato,)) + _codificar(respuesta, formato)
+
+def desempaquetar_respuesta(paquete_bytes: bytes) -> Dict[str, Any]:
+    """
+    Desempaqueta una respuesta recibida del servidor
+    
+    Raises:
+        ValueError: Si el paquete está vacío, el formato es desconocido
+            o el contenido no se puede decodificar
+    """
+    if not paquete_bytes:
+        raise ValueError("Respuesta vacia")
+    return _decodificar(paquete_bytes[1:], paquete_bytes[0])
\ No newline at end of file
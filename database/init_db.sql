@@ -12,21 +12,25 @@ CREATE TABLE IF NOT EXISTS transacciones (
     username TEXT NOT NULL,
     cuenta_origen TEXT NOT NULL,
     cuenta_destino TEXT NOT NULL,
-    cantidad REAL NOT NULL,
+    cantidad_cents INTEGER NOT NULL,  -- céntimos de euro (sin errores de float)
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     mac_verificado BOOLEAN DEFAULT TRUE,
     FOREIGN KEY (username) REFERENCES usuarios(username)
 );
 
 -- Tabla de NONCEs (anti-replay)
+-- WITHOUT ROWID: el propio NONCE es la clave del B-tree, sin índice aparte
 CREATE TABLE IF NOT EXISTS nonces (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    valor BLOB UNIQUE NOT NULL,
-    expira TIMESTAMP NOT NULL,
+    valor BLOB PRIMARY KEY NOT NULL,
+    expira INTEGER NOT NULL,  -- epoch en segundos
     usado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+) WITHOUT ROWID;
 
 -- Índices para optimizar búsquedas
 CREATE UNIQUE INDEX IF NOT EXISTS idx_username ON usuarios(username);
-CREATE INDEX IF NOT EXISTS idx_nonce_valor ON nonces(valor);
-CREATE INDEX IF NOT EXISTS idx_nonce_expira ON nonces(expira);
\ No newline at end of file
+-- idx_nonce_valor duplicaba el índice de la restricción única sobre valor
+DROP INDEX IF EXISTS idx_nonce_valor;
+CREATE INDEX IF NOT EXISTS idx_nonce_expira ON nonces(expira);
+
+-- Versión del esquema (DatabaseManager no repite el script si ya está aplicada)
+PRAGMA user_version = 3;
\ No newline at end of file
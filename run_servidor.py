@@ -13,6 +13,7 @@ sys.path.insert(0, str(Path(__file__).parent))
 Path("logs").mkdir(exist_ok=True)
 
 from server.server import main, ServidorBancario
+from common.logging_config import configurar_logging_basico
 
 # Variable global para el servidor
 servidor_global = None
@@ -32,14 +33,14 @@ if __name__ == "__main__":
         signal.signal(signal.SIGTERM, signal_handler)  # kill
     
     try:
-        # Configurar logging
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
+        # Configurar logging (sin propagar fallos de los handlers)
+        logging.raiseExceptions = False
+        configurar_logging_basico(
             handlers=[
                 logging.FileHandler('logs/servidor.log', encoding='utf-8'),
                 logging.StreamHandler(sys.stdout)
-            ]
+            ],
+            en_segundo_plano=True
         )
         
         # Crear servidor
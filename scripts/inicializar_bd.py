@@ -20,8 +20,17 @@ def main():
     try:
         # Crear instancia de DatabaseManager (automáticamente inicializa la BD)
         db = DatabaseManager(Config.DB_PATH)
+        
+        # DatabaseManager solo activa WAL al crear o migrar el esquema: se
+        # fuerza también sobre una BD ya al día (el modo queda en el fichero;
+        # el resto de PRAGMAS_CONEXION los aplica cada conexión al abrirse)
+        with db.get_connection() as conn:
+            (modo,) = conn.execute("PRAGMA journal_mode = WAL").fetchone()
+        db.cerrar()
+        
         print("✅ Base de datos inicializada correctamente")
         print(f"✓ Tablas creadas: usuarios, transacciones, nonces")
+        print(f"✓ Modo de journal: {modo}")
         
     except Exception as e:
         print(f"❌ Error al inicializar la base de datos: {e}")
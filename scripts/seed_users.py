@@ -3,7 +3,7 @@
 scripts/seed_users.py
 ─────────────────────────────────────────────────────────────────────────────
 Pobla la base de datos con usuarios de prueba pre-registrados.
-Usa Argon2id con los MISMOS parámetros definidos en common/constantes.py.
+Usa Argon2id con los parámetros de common/constantes.py (importados, no copiados).
 
 Uso:
     python scripts/seed_users.py                  # BD por defecto (database/usuarios.db)
@@ -12,9 +12,11 @@ Uso:
 ─────────────────────────────────────────────────────────────────────────────
 """
 
+import os
 import sqlite3
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
@@ -26,12 +28,16 @@ except ImportError:
     print("        pip install argon2-cffi")
     sys.exit(1)
 
-# ── Parámetros Argon2id (espejo de common/constantes.py) ──────────────────────
-ARGON2_TIME_COST    = 3       # iteraciones
-ARGON2_MEMORY_COST  = 65536  # 64 MB
-ARGON2_PARALLELISM  = 4       # hilos
-ARGON2_HASH_LEN     = 32      # bytes
-ARGON2_SALT_LEN     = 16      # bytes
+# ── Parámetros Argon2id (los mismos que usa el servidor) ──────────────────────
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from common.constantes import (
+    ARGON2_TIME_COST,
+    ARGON2_MEMORY_COST,
+    ARGON2_PARALLELISM,
+    ARGON2_HASH_LEN,
+    ARGON2_SALT_LEN,
+)
 
 # ── Ruta por defecto de la BD ──────────────────────────────────────────────────
 DEFAULT_DB_PATH = Path(__file__).parent.parent / "database" / "usuarios.db"
@@ -72,9 +78,13 @@ def conectar_bd(db_path: Path) -> sqlite3.Connection:
         print("        Ejecuta primero:  python scripts/inicializar_bd.py")
         sys.exit(1)
 
-    conn = sqlite3.connect(str(db_path))
+    # Transacciones explícitas (BEGIN/COMMIT) en lugar de las implícitas de sqlite3
+    conn = sqlite3.connect(str(db_path), isolation_level=None)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
+    # Mismo modo que server/database.py (WAL + synchronous=NORMAL)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
     return conn
 
 
@@ -89,12 +99,24 @@ def tabla_existe(conn: sqlite3.Connection, nombre: str) -> bool:
 
 def reset_usuarios(conn: sqlite3.Connection) -> None:
     """Elimina todos los usuarios existentes (y sus transacciones por FK)."""
+    conn.execute("BEGIN")
     conn.execute("DELETE FROM transacciones")
     conn.execute("DELETE FROM usuarios")
-    conn.commit()
+    conn.execute("COMMIT")
     print("[*] Tabla usuarios vaciada (--reset)\n")
 
 
+def hashear_en_paralelo(passwords: list, ph: PasswordHasher) -> list:
+    """
+    Hashea varias contraseñas a la vez (mismo orden que la entrada).
+    argon2-cffi libera el GIL durante el hash, así que los hilos
+    aprovechan núcleos reales; cada hash ya usa ARGON2_PARALLELISM hilos.
+    """
+    workers = max(1, (os.cpu_count() or 1) // ARGON2_PARALLELISM)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(ph.hash, passwords))
+
+
 def insertar_usuarios(conn: sqlite3.Connection, usuarios: list, ph: PasswordHasher) -> None:
     """Inserta los usuarios hasheando cada contraseña con Argon2id."""
     print(f"[*] Insertando {len(usuarios)} usuarios...\n")
@@ -104,33 +126,41 @@ def insertar_usuarios(conn: sqlite3.Connection, usuarios: list, ph: PasswordHash
     insertados = 0
     omitidos   = 0
 
+    # Separar los que ya existen antes de gastar tiempo hasheando (una sola consulta)
+    existentes = {fila[0] for fila in conn.execute("SELECT username FROM usuarios")}
+    pendientes = []
     for u in usuarios:
-        username = u["username"]
-        password = u["password"]
-
-        try:
-            # Verificar si ya existe
-            cur = conn.execute(
-                "SELECT id FROM usuarios WHERE username = ?", (username,)
-            )
-            if cur.fetchone():
-                print(f"    {username:<15} OMITIDO (ya existe)")
-                omitidos += 1
-                continue
-
-            # Hashear con Argon2id
-            password_hash = ph.hash(password)
-
-            conn.execute(
-                "INSERT INTO usuarios (username, password_hash, created_at) VALUES (?, ?, ?)",
-                (username, password_hash, datetime.now().isoformat())
-            )
-            conn.commit()
+        if u["username"] in existentes:
+            print(f"    {u['username']:<15} OMITIDO (ya existe)")
+            omitidos += 1
+        else:
+            pendientes.append(u)
+
+    # Hashear con Argon2id (todas las contraseñas pendientes a la vez)
+    hashes = hashear_en_paralelo([u["password"] for u in pendientes], ph)
+
+    # Un único INSERT múltiple y un único commit (un solo fsync)
+    ahora = datetime.now().isoformat()
+    filas = [
+        (u["username"], password_hash, ahora)
+        for u, password_hash in zip(pendientes, hashes)
+    ]
+
+    try:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO usuarios (username, password_hash, created_at) VALUES (?, ?, ?)",
+            filas
+        )
+        conn.execute("COMMIT")
+        for username, _, _ in filas:
             print(f"    {username:<15} OK")
-            insertados += 1
+        insertados = len(filas)
 
-        except Exception as e:
-            conn.rollback()
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        for username, _, _ in filas:
             print(f"    {username:<15} ERROR -> {e}")
 
     print()
@@ -2,11 +2,24 @@
 """
 Lógica de autenticación: registro y login
 """
+import hashlib
+import hmac
 import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from typing import Tuple, Optional
 
 from server.database import DatabaseManager
-from server.crypto_server import hashear_password, verificar_password
+from server.crypto_server import hashear_password, verificar_password, necesita_rehash
+from common.config import Config
+from common.constantes import (
+    ARGON2_TIEMPO_MIN_MS,
+    ARGON2_TIEMPO_MAX_MS,
+    CACHE_LOGIN_TTL,
+    CACHE_LOGIN_MAX
+)
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +28,72 @@ class Autenticacion:
     
     def __init__(self, db: DatabaseManager):
         self.db = db
+        # Hash Argon2 ficticio: el login de un usuario inexistente también
+        # verifica una contraseña, y tarda lo mismo que el de uno existente
+        inicio = time.perf_counter()
+        self._hash_ficticio = hashear_password(secrets.token_hex(16))
+        if not Config.TEST_MODE:  # En tests el coste es bajo a propósito
+            self._comprobar_coste_argon2((time.perf_counter() - inicio) * 1000)
+        
+        # Logins verificados recientemente: username -> (huella, hash, instante)
+        # La huella es un BLAKE2b con una clave aleatoria del proceso, así que
+        # no sirve para atacar la contraseña fuera de este proceso; el hash es
+        # el de la BD cuando se verificó (si cambia, la entrada ya no vale)
+        self._clave_cache = secrets.token_bytes(32)
+        self._cache_logins: "OrderedDict[str, Tuple[bytes, str, float]]" = OrderedDict()
+        self._lock_cache = threading.Lock()
+    
+    def _huella(self, username: str, password: str) -> bytes:
+        """Huella rápida de (usuario, contraseña) para la caché de logins"""
+        usuario = username.encode('utf-8')
+        h = hashlib.blake2b(key=self._clave_cache, digest_size=32)
+        h.update(len(usuario).to_bytes(4, 'big'))
+        h.update(usuario)
+        h.update(password.encode('utf-8'))
+        return h.digest()
+    
+    def _login_en_cache(self, username: str, huella: bytes, password_hash: str) -> bool:
+        """
+        True si el usuario hizo login con esa contraseña hace menos de
+        CACHE_LOGIN_TTL y su hash en la BD (password_hash) no ha cambiado
+        desde entonces (contraseña cambiada, usuario borrado y recreado...)
+        """
+        with self._lock_cache:
+            entrada = self._cache_logins.get(username)
+            if entrada is None:
+                return False
+            huella_guardada, hash_guardado, instante = entrada
+            if (time.monotonic() - instante >= CACHE_LOGIN_TTL
+                    or not hmac.compare_digest(hash_guardado, password_hash)):
+                del self._cache_logins[username]
+                return False
+            self._cache_logins.move_to_end(username)
+        return hmac.compare_digest(huella_guardada, huella)
+    
+    def _guardar_login(self, username: str, huella: bytes, password_hash: str):
+        """Recuerda un login correcto (expulsa el menos reciente si está llena)"""
+        with self._lock_cache:
+            self._cache_logins[username] = (huella, password_hash, time.monotonic())
+            self._cache_logins.move_to_end(username)
+            if len(self._cache_logins) > CACHE_LOGIN_MAX:
+                self._cache_logins.popitem(last=False)
+    
+    def olvidar_login(self, username: str):
+        """Invalida la caché de un usuario (p. ej. al cambiar su contraseña)"""
+        with self._lock_cache:
+            self._cache_logins.pop(username, None)
+    
+    @staticmethod
+    def _comprobar_coste_argon2(ms: float):
+        """Avisa si el coste de Argon2 en esta máquina está fuera de rango"""
+        if ms < ARGON2_TIEMPO_MIN_MS:
+            logger.warning("[WARNING] Argon2 tarda %.0f ms por hash: coste demasiado bajo "
+                           "(minimo %d ms), revisar ARGON2_*", ms, ARGON2_TIEMPO_MIN_MS)
+        elif ms > ARGON2_TIEMPO_MAX_MS:
+            logger.warning("[WARNING] Argon2 tarda %.0f ms por hash: coste demasiado alto "
+                           "(maximo %d ms), revisar ARGON2_*", ms, ARGON2_TIEMPO_MAX_MS)
+        else:
+            logger.info("[OK] Argon2: %.0f ms por hash", ms)
     
     def registrar(self, username: str, password: str) -> Tuple[bool, str]:
         """
@@ -27,24 +106,26 @@ class Autenticacion:
         Returns:
             Tuple[bool, str]: (éxito, mensaje)
         """
+        self.olvidar_login(username)
+        
         # Validar que el usuario no exista
         if self.db.usuario_existe(username):
-            logger.warning(f"[WARNING]  Intento de registro con usuario existente: {username}")
+            logger.warning("[WARNING]  Intento de registro con usuario existente: %s", username)
             return False, "El usuario ya existe"
         
         # Hashear contraseña con Argon2id
         try:
             password_hash = hashear_password(password)
         except Exception as e:
-            logger.error(f"[ERROR] Error al hashear contraseña: {e}")
+            logger.error("[ERROR] Error al hashear contraseña: %s", e)
             return False, "Error al procesar la contraseña"
         
         # Crear usuario en BD
         if self.db.crear_usuario(username, password_hash):
-            logger.info(f"[OK] Usuario registrado: {username}")
+            logger.info("[OK] Usuario registrado: %s", username)
             return True, "Usuario registrado exitosamente"
         else:
-            logger.error(f"[ERROR] Error al crear usuario: {username}")
+            logger.error("[ERROR] Error al crear usuario: %s", username)
             return False, "Error al crear el usuario"
     
     def login(self, username: str, password: str) -> Tuple[bool, str]:
@@ -58,17 +139,38 @@ class Autenticacion:
         Returns:
             Tuple[bool, str]: (éxito, mensaje)
         """
-        # Verificar que el usuario exista
         password_hash = self.db.obtener_password_hash(username)
-        if not password_hash:
-            logger.warning(f"[WARNING]  Intento de login con usuario inexistente: {username}")
+        usuario_existe = password_hash is not None
+        
+        # Login repetido dentro del TTL con el mismo hash en la BD: sin Argon2
+        # (la consulta del hash sí se hace: un usuario borrado o con la
+        # contraseña cambiada no puede entrar con la contraseña en caché)
+        huella = self._huella(username, password)
+        if usuario_existe and self._login_en_cache(username, huella, password_hash):
+            logger.info("[OK] Login exitoso (cache): %s", username)
+            return True, "Login exitoso"
+        
+        # Verificar contraseña en tiempo constante, exista o no el usuario
+        # (sin salida temprana que permita enumerar usuarios por tiempo)
+        password_valida = verificar_password(
+            password_hash if usuario_existe else self._hash_ficticio, password
+        )
+        
+        if not usuario_existe:
+            logger.warning("[WARNING]  Intento de login con usuario inexistente: %s", username)
             # Mensaje genérico por seguridad (no revelar si existe)
             return False, "Credenciales incorrectas"
         
-        # Verificar contraseña en tiempo constante
-        if verificar_password(password_hash, password):
-            logger.info(f"[OK] Login exitoso: {username}")
+        if password_valida:
+            # Hash creado con parámetros antiguos: actualizarlo ahora que
+            # se conoce la contraseña
+            if necesita_rehash(password_hash):
+                password_hash = hashear_password(password)
+                self.db.actualizar_password_hash(username, password_hash)
+                logger.info("[OK] Hash de contraseña actualizado: %s", username)
+            self._guardar_login(username, huella, password_hash)
+            logger.info("[OK] Login exitoso: %s", username)
             return True, "Login exitoso"
         else:
-            logger.warning(f"[WARNING]  Contraseña incorrecta para usuario: {username}")
+            logger.warning("[WARNING]  Contraseña incorrecta para usuario: %s", username)
             return False, "Credenciales incorrectas"
\ No newline at end of file
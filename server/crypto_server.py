@@ -5,34 +5,86 @@ Incluye verificación de integridad (MAC) + anti-replay (NONCE)
 """
 import hmac
 import logging
+import os
+import threading
+from collections import OrderedDict
 from typing import Tuple, Optional
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
 
+from common.config import Config
 from common.crypto__utils import verificar_mac
 from common.constantes import (
     ARGON2_TIME_COST,
     ARGON2_MEMORY_COST,
     ARGON2_PARALLELISM,
     ARGON2_HASH_LEN,
-    ARGON2_SALT_LEN
+    ARGON2_SALT_LEN,
+    ARGON2_TEST_TIME_COST,
+    ARGON2_TEST_MEMORY_COST,
+    ARGON2_TEST_PARALLELISM
 )
 
 logger = logging.getLogger(__name__)
 
+def _crear_hasher() -> PasswordHasher:
+    """PasswordHasher con el coste de producción, o el reducido si Config.TEST_MODE"""
+    if Config.TEST_MODE:
+        return PasswordHasher(
+            time_cost=ARGON2_TEST_TIME_COST,
+            memory_cost=ARGON2_TEST_MEMORY_COST,
+            parallelism=ARGON2_TEST_PARALLELISM,
+            hash_len=ARGON2_HASH_LEN,
+            salt_len=ARGON2_SALT_LEN
+        )
+    return PasswordHasher(
+        time_cost=ARGON2_TIME_COST,
+        memory_cost=ARGON2_MEMORY_COST,
+        parallelism=ARGON2_PARALLELISM,
+        hash_len=ARGON2_HASH_LEN,
+        salt_len=ARGON2_SALT_LEN
+    )
+
 # Configurar Argon2
-ph = PasswordHasher(
-    time_cost=ARGON2_TIME_COST,
-    memory_cost=ARGON2_MEMORY_COST,
-    parallelism=ARGON2_PARALLELISM,
-    hash_len=ARGON2_HASH_LEN,
-    salt_len=ARGON2_SALT_LEN
-)
+ph = _crear_hasher()
+
+def reconfigurar_argon2():
+    """
+    Vuelve a crear el hasher tras cambiar Config.TEST_MODE
+    
+    Los hashes ya guardados se siguen verificando (llevan sus parámetros);
+    necesita_rehash() los marcará para rehashear con el coste nuevo
+    """
+    global ph
+    ph = _crear_hasher()
+
+# argon2-cffi libera el GIL, así que los hilos ya hashean en paralelo;
+# se limita cuántos a la vez para no reservar 64 MB por cada hilo de cliente
+_argon2_simultaneos = threading.BoundedSemaphore(os.cpu_count() or 1)
 
 # ===================================================================
 # VALIDACIÓN COMPLETA DE MENSAJES (MAC + NONCE)
 # ===================================================================
 
+# NONCEs aceptados recientemente (LRU en memoria)
+# Un replay de un NONCE reciente se rechaza sin consultar la BD;
+# la BD sigue siendo la fuente de verdad para todo lo demás
+MAX_NONCES_EN_MEMORIA = 100_000
+_nonces_vistos: "OrderedDict[bytes, None]" = OrderedDict()
+_lock_nonces = threading.Lock()
+
+def _nonce_visto(nonce: bytes) -> bool:
+    """True si el NONCE ya se aceptó recientemente en este proceso"""
+    with _lock_nonces:
+        return nonce in _nonces_vistos
+
+def _recordar_nonce(nonce: bytes):
+    """Guarda un NONCE aceptado, descartando el más antiguo si se llena"""
+    with _lock_nonces:
+        _nonces_vistos[nonce] = None
+        if len(_nonces_vistos) > MAX_NONCES_EN_MEMORIA:
+            _nonces_vistos.popitem(last=False)
+
 class MensajeInvalido(Exception):
     """Excepción cuando un mensaje no pasa las validaciones"""
     pass
@@ -83,13 +135,17 @@ def verificar_mensaje_completo(
     logger.debug("[OK] MAC válido - Integridad verificada")
     
     # PASO 2: Verificar que el NONCE no ha sido usado (anti-replay)
-    if not db_manager.validar_nonce(nonce):
+    # Primero en memoria (replays recientes), después en la BD
+    if _nonce_visto(nonce) or not db_manager.validar_nonce(nonce):
         logger.warning(
-            f"[ERROR] NONCE duplicado detectado - REPLAY ATTACK! NONCE: {nonce.hex()[:16]}..."
+            "[ERROR] NONCE duplicado detectado - REPLAY ATTACK! NONCE: %s...", nonce.hex()[:16]
         )
         raise MensajeInvalido("NONCE ya usado - Replay attack detectado")
     
-    logger.debug(f"[OK] NONCE válido y registrado: {nonce.hex()[:16]}...")
+    _recordar_nonce(nonce)
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[OK] NONCE válido y registrado: %s...", nonce.hex()[:16])
     
     # TODAS LAS VALIDACIONES PASADAS
     logger.info("[OK] Mensaje completamente validado (MAC + NONCE)")
@@ -111,7 +167,8 @@ def hashear_password(password: str) -> str:
     Returns:
         str: Hash de la contraseña (incluye salt automáticamente)
     """
-    return ph.hash(password)
+    with _argon2_simultaneos:
+        return ph.hash(password)
 
 
 def verificar_password(password_hash: str, password: str) -> bool:
@@ -126,12 +183,26 @@ def verificar_password(password_hash: str, password: str) -> bool:
         bool: True si la contraseña es correcta
     """
     try:
-        ph.verify(password_hash, password)
+        with _argon2_simultaneos:
+            ph.verify(password_hash, password)
         return True
     except VerifyMismatchError:
         return False
 
 
+def necesita_rehash(password_hash: str) -> bool:
+    """
+    Indica si un hash se generó con parámetros distintos a los actuales
+    
+    Args:
+        password_hash: Hash almacenado en BD
+    
+    Returns:
+        bool: True si conviene volver a hashear la contraseña
+    """
+    return ph.check_needs_rehash(password_hash)
+
+
 def secure_compare(a: bytes, b: bytes) -> bool:
     """
     Comparación en tiempo constante (protección contra timing attacks)
@@ -1,7 +1,10 @@
 import logging
 import sqlite3
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Optional, List, Tuple
 from contextlib import contextmanager
 import logging
@@ -20,39 +23,168 @@ def _convert_datetime(val: bytes) -> datetime:
 sqlite3.register_adapter(datetime, _adapt_datetime)
 sqlite3.register_converter("TIMESTAMP", _convert_datetime)
 
+# PRAGMAs por conexión (no se guardan en el fichero)
+# - synchronous=NORMAL: con WAL, un fsync por checkpoint en lugar de por commit
+# - busy_timeout: esperar al escritor en lugar de fallar con SQLITE_BUSY
+# - temp_store/mmap/cache_size: temporales en memoria, lecturas sin read()
+#   por página y ~20 MB de caché de páginas
+# - foreign_keys: hacer cumplir la FK transacciones.username -> usuarios
+PRAGMAS_CONEXION = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",  # 256 MB
+    "PRAGMA cache_size = -20000",    # en KiB
+    "PRAGMA foreign_keys = ON",
+)
+
+# Sentencias compiladas que sqlite3 guarda por conexión (por defecto 128)
+SENTENCIAS_EN_CACHE = 256
+
+# Debe coincidir con el PRAGMA user_version del final de init_db.sql
+# 1: esquema inicial | 2: transacciones.cantidad REAL -> cantidad_cents INTEGER
+# 3: nonces con rowid (id AUTOINCREMENT) -> WITHOUT ROWID con clave valor,
+#    y nonces.expira texto ISO -> epoch entero
+VERSION_ESQUEMA = 3
+
+@lru_cache(maxsize=1)
+def _leer_script_inicial() -> Optional[str]:
+    """Contenido de init_db.sql (se lee una vez por proceso)"""
+    sql_path = Path("database/init_db.sql")
+    if not sql_path.exists():
+        return None
+    return sql_path.read_text(encoding='utf-8')
+
 class DatabaseManager:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        # URI de SQLite ("file:..."), p. ej. BD en memoria compartida en los tests
+        self._es_uri = db_path.startswith("file:")
+        # Una conexión persistente por hilo (cada cliente se atiende en su hilo)
+        self._local = threading.local()
         self._inicializar_bd()
     
     def _inicializar_bd(self):
         """Crea las tablas si no existen"""
-        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        if not self._es_uri:
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
         
         with self.get_connection() as conn:
-            # Leer y ejecutar script SQL
-            sql_path = Path("database/init_db.sql")
-            if sql_path.exists():
-                conn.executescript(sql_path.read_text(encoding='utf-8'))
+            # BD ya inicializada con este esquema: no repetir el script
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            if version >= VERSION_ESQUEMA:
+                return
+            
+            # WAL es persistente: basta con activarlo una vez sobre el fichero
+            conn.execute("PRAGMA journal_mode = WAL")
+            
+            # Esquema 1: apartar la tabla con cantidad REAL para recrearla
+            columnas = {fila['name'] for fila in conn.execute("PRAGMA table_info(transacciones)")}
+            if "cantidad" in columnas:
+                conn.executescript("ALTER TABLE transacciones RENAME TO transacciones_v1;")
+            
+            # Esquemas 1-2: apartar la tabla de NONCEs con rowid para recrearla
+            columnas = {fila['name'] for fila in conn.execute("PRAGMA table_info(nonces)")}
+            if "id" in columnas:
+                conn.executescript("""
+                    DROP INDEX IF EXISTS idx_nonce_expira;
+                    ALTER TABLE nonces RENAME TO nonces_v1;
+                """)
+            
+            # Ejecutar script SQL
+            script = _leer_script_inicial()
+            if script is not None:
+                conn.executescript(script)
             else:
                 print("⚠️  Advertencia: No se encontró init_db.sql")
+                return
+            
+            # Copiar las transacciones antiguas convirtiendo euros a céntimos
+            if conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transacciones_v1'"
+            ).fetchone():
+                conn.executescript("""
+                    BEGIN;
+                    INSERT INTO transacciones
+                        (id, username, cuenta_origen, cuenta_destino, cantidad_cents,
+                         timestamp, mac_verificado)
+                    SELECT id, username, cuenta_origen, cuenta_destino,
+                           CAST(ROUND(cantidad * 100) AS INTEGER), timestamp, mac_verificado
+                    FROM transacciones_v1;
+                    DROP TABLE transacciones_v1;
+                    COMMIT;
+                """)
+            
+            # Copiar los NONCEs aún registrados a la tabla WITHOUT ROWID
+            if conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'nonces_v1'"
+            ).fetchone():
+                conn.executescript("""
+                    BEGIN;
+                    INSERT OR IGNORE INTO nonces (valor, expira, usado_en)
+                    SELECT valor, expira, usado_en FROM nonces_v1;
+                    DROP TABLE nonces_v1;
+                    COMMIT;
+                """)
+            
+            # Esquemas 1-2 guardaban expira como texto ISO en hora local: pasarlo
+            # a epoch entero, o "expira < ?" no lo compara y nunca se limpia
+            # (0 si no se puede interpretar: se borra en la siguiente limpieza)
+            conn.executescript("""
+                BEGIN;
+                UPDATE nonces
+                SET expira = COALESCE(CAST(strftime('%s', expira, 'utc') AS INTEGER), 0)
+                WHERE typeof(expira) = 'text';
+                COMMIT;
+            """)
+    
+    def _conexion_hilo(self) -> sqlite3.Connection:
+        """
+        Devuelve la conexión del hilo actual, abriéndola en el primer uso
+        
+        La conexión se reutiliza entre peticiones: se evita el coste de
+        connect + PRAGMAs y las sentencias ya compiladas quedan en su caché
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # AÑADIR: detect_types para usar los convertidores (solucion para prolema  con datetime deprecated)
+            conn = sqlite3.connect(
+                self.db_path,
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                cached_statements=SENTENCIAS_EN_CACHE,
+                # Las escrituras abren BEGIN IMMEDIATE: toman el bloqueo de
+                # escritura al empezar y no a mitad de la transacción
+                isolation_level="IMMEDIATE",
+                uri=self._es_uri
+            )
+            conn.row_factory = sqlite3.Row
+            for pragma in PRAGMAS_CONEXION:
+                conn.execute(pragma)
+            self._local.conn = conn
+        return conn
     
     @contextmanager
     def get_connection(self):
-        # AÑADIR: detect_types para usar los convertidores (solucion para prolema  con datetime deprecated)
-        conn = sqlite3.connect(
-            self.db_path,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-        )
-        conn.row_factory = sqlite3.Row
+        """
+        Transacción sobre la conexión persistente del hilo
+        
+        Cada bloque with es una transacción lógica: COMMIT al salir sin
+        errores, ROLLBACK si se produce una excepción
+        """
+        conn = self._conexion_hilo()
         try:
             yield conn
             conn.commit()
         except Exception as e:
             conn.rollback()
             raise e
-        finally:
+    
+    def cerrar(self):
+        """Cierra la conexión del hilo actual (se reabre en el siguiente uso)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
             conn.close()
+            self._local.conn = None
     
     # === GESTIÓN DE USUARIOS ===
     
@@ -73,6 +205,14 @@ class DatabaseManager:
         except sqlite3.IntegrityError:
             return False  # Usuario ya existe
     
+    def actualizar_password_hash(self, username: str, password_hash: str):
+        """Sustituye el hash de contraseña de un usuario (p. ej. tras un rehash)"""
+        with self.get_connection() as conn:
+            conn.execute(
+                "UPDATE usuarios SET password_hash = ? WHERE username = ?",
+                (password_hash, username)
+            )
+    
     def obtener_password_hash(self, username: str) -> Optional[str]:
         """Obtiene el hash de contraseña de un usuario"""
         with self.get_connection() as conn:
@@ -100,22 +240,41 @@ class DatabaseManager:
         Returns:
             bool: True si el NONCE es válido (no usado), False si ya fue usado
         """
+        # Expiración como epoch entero: sin conversión a texto ISO y
+        # comparaciones numéricas en el índice idx_nonce_expira
+        expira = int(time.time()) + duracion_minutos * 60
         with self.get_connection() as conn:
-            # Verificar si el NONCE ya existe
+            # Comprobar y registrar en una sola sentencia atómica: la
+            # restricción UNIQUE(valor) descarta el NONCE si ya existe
             cursor = conn.execute(
-                "SELECT id FROM nonces WHERE valor = ?",
-                (nonce,)
-            )
-            if cursor.fetchone():
-                return False  # NONCE ya usado - Ataque replay detectado!
-            
-            # Registrar el NONCE con fecha de expiración
-            expira = datetime.now() + timedelta(minutes=duracion_minutos)
-            conn.execute(
-                "INSERT INTO nonces (valor, expira) VALUES (?, ?)",
+                "INSERT OR IGNORE INTO nonces (valor, expira) VALUES (?, ?)",
                 (nonce, expira)
             )
-            return True
+            # rowcount == 0 -> NONCE ya usado - Ataque replay detectado!
+            return cursor.rowcount == 1
+    
+    def limpiar_nonces_expirados(self, tam_lote: int = 10_000) -> int:
+        """
+        Elimina los NONCEs caducados en lotes de tam_lote filas
+        
+        Cada lote es una transacción corta, para no retener el bloqueo de
+        escritura mientras hay peticiones esperando
+        
+        Returns:
+            int: Número de NONCEs eliminados
+        """
+        ahora = int(time.time())
+        total = 0
+        while True:
+            with self.get_connection() as conn:
+                cursor = conn.execute(
+                    """DELETE FROM nonces WHERE valor IN
+                       (SELECT valor FROM nonces WHERE expira < ? LIMIT ?)""",
+                    (ahora, tam_lote)
+                )
+            total += cursor.rowcount
+            if cursor.rowcount < tam_lote:
+                return total
     
     
     # === GESTIÓN DE TRANSACCIONES ===
@@ -125,31 +284,66 @@ class DatabaseManager:
         username: str,
         cuenta_origen: str,
         cuenta_destino: str,
-        cantidad: float,
+        cantidad_cents: int,
         mac_verificado: bool = True
     ) -> int:
         """
         Registra una transacción
         
+        Args:
+            cantidad_cents: Importe en céntimos de euro
+        
         Returns:
             int: ID de la transacción creada
         """
         with self.get_connection() as conn:
             cursor = conn.execute(
                 """INSERT INTO transacciones 
-                   (username, cuenta_origen, cuenta_destino, cantidad, mac_verificado)
+                   (username, cuenta_origen, cuenta_destino, cantidad_cents, mac_verificado)
                    VALUES (?, ?, ?, ?, ?)""",
-                (username, cuenta_origen, cuenta_destino, cantidad, mac_verificado)
+                (username, cuenta_origen, cuenta_destino, cantidad_cents, mac_verificado)
             )
             return cursor.lastrowid
     
-    def obtener_transacciones_usuario(self, username: str) -> List[dict]:
-        """Obtiene todas las transacciones de un usuario"""
+    def obtener_transacciones_usuario(
+        self,
+        username: str,
+        limite: Optional[int] = None,
+        desplazamiento: int = 0
+    ) -> List[dict]:
+        """
+        Obtiene las transacciones de un usuario (más recientes primero)
+        
+        Args:
+            username: Usuario
+            limite: Máximo de transacciones a devolver (None = todas)
+            desplazamiento: Transacciones a saltar (paginación)
+        """
         with self.get_connection() as conn:
+            # Solo las columnas que se muestran (username ya es conocido).
+            # timestamp tiene resolución de segundos: id desempata para que
+            # las páginas no repitan ni salten transacciones del mismo segundo
             cursor = conn.execute(
-                """SELECT * FROM transacciones 
+                """SELECT id, cuenta_origen, cuenta_destino, cantidad_cents, timestamp
+                   FROM transacciones 
                    WHERE username = ? 
-                   ORDER BY timestamp DESC""",
-                (username,)
+                   ORDER BY timestamp DESC, id DESC
+                   LIMIT ? OFFSET ?""",
+                (username, -1 if limite is None else limite, desplazamiento)
             )
-            return [dict(row) for row in cursor.fetchall()]
\ No newline at end of file
+            return [dict(row) for row in cursor]
+    
+    def contar_transacciones(self, username: str, cantidad_cents: int) -> int:
+        """
+        Cuenta las transacciones de un usuario por un importe exacto
+        
+        Args:
+            username: Usuario
+            cantidad_cents: Importe en céntimos
+        """
+        with self.get_connection() as conn:
+            (total,) = conn.execute(
+                "SELECT COUNT(*) FROM transacciones WHERE username = ? AND cantidad_cents = ?",
+                (username, cantidad_cents)
+            ).fetchone()
+            return total
\ No newline at end of file
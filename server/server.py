@@ -1,17 +1,17 @@
 # servidor/servidor.py
 """
-Servidor principal - Maneja UNA petición por conexión
-OPCIÓN 1: Cierra después de cada respuesta
+Servidor principal - Conexiones persistentes
+Cada conexión atiende peticiones hasta que el cliente la cierra
 """
-from collections import defaultdict
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import selectors
 import socket
 import threading
+import time
 import logging
-import json
 import signal
 import sys
-import re
 from typing import Optional
 
 from server.database import DatabaseManager
@@ -19,12 +19,81 @@ from server.crypto_server import verificar_mensaje_completo, MensajeInvalido
 from server.autenticacion import Autenticacion
 from server.transacciones import GestorTransacciones
 from common.config import Config
-from common.protocolo import Mensaje
+from common.constantes import (
+    MAX_ITEMS_LOTE, MAX_ARGON2_LOTE, FORMATO_JSON, INTERVALO_LIMPIEZA_NONCES, LOTE_LIMPIEZA_NONCES
+)
+from common.protocolo import Mensaje, enmarcar, recibir_trama, empaquetar_respuesta
+from common.logging_config import configurar_logging_basico
 
 logger = logging.getLogger(__name__)
 
+class LimitadorTrazas:
+    """
+    Cubeta de fichas: como mucho `por_segundo` trazas completas por segundo
+    
+    Formatear un traceback recorre la pila y lee los fuentes; ante una
+    avalancha de errores solo se guarda la traza de unos pocos
+    """
+    __slots__ = ('por_segundo', '_fichas', '_ultimo', '_lock')
+    
+    def __init__(self, por_segundo: float = 10):
+        self.por_segundo = por_segundo
+        self._fichas = por_segundo
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def permitir(self) -> bool:
+        """True si se puede registrar una traza completa ahora"""
+        with self._lock:
+            ahora = time.monotonic()
+            self._fichas = min(self.por_segundo,
+                               self._fichas + (ahora - self._ultimo) * self.por_segundo)
+            self._ultimo = ahora
+            if self._fichas >= 1:
+                self._fichas -= 1
+                return True
+            return False
+
+@lru_cache(maxsize=32)
+def _trama_error(mensaje: str, formato: int) -> bytes:
+    """
+    Trama completa de una respuesta de error fija
+    
+    Los rechazos (paquete ilegible, MAC inválido, replay) usan siempre los
+    mismos textos: se serializan y enmarcan una sola vez por formato
+    """
+    return enmarcar(empaquetar_respuesta({"status": "error", "mensaje": mensaje}, formato))
+
+# Clases de carácter para validar contraseñas
+CLASE_MAYUSCULA, CLASE_MINUSCULA, CLASE_DIGITO, CLASE_ESPECIAL = 1, 2, 3, 4
+
+def _tabla_clases() -> bytes:
+    """Tabla de 256 entradas: byte -> clase de carácter (0 = ninguna)"""
+    tabla = bytearray(256)
+    for caracteres, clase in (
+        (b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", CLASE_MAYUSCULA),
+        (b"abcdefghijklmnopqrstuvwxyz", CLASE_MINUSCULA),
+        (b"0123456789", CLASE_DIGITO),
+        (b'!@#$%^&*(),.?":{}|<>_-+=[]\\/~`', CLASE_ESPECIAL),
+    ):
+        for c in caracteres:
+            tabla[c] = clase
+    return bytes(tabla)
+
+# Un solo bytes.translate() clasifica toda la contraseña (en lugar de un
+# re.search por requisito); los bytes no ASCII caen en la clase 0
+_CLASES_CARACTER = _tabla_clases()
+
+# Requisitos de contraseña: (clase requerida, mensaje de error)
+REQUISITOS_PASSWORD = (
+    (CLASE_MAYUSCULA, "Debe contener al menos una letra mayúscula (A-Z)"),
+    (CLASE_MINUSCULA, "Debe contener al menos una letra minúscula (a-z)"),
+    (CLASE_DIGITO, "Debe contener al menos un número (0-9)"),
+    (CLASE_ESPECIAL, "Debe contener al menos un carácter especial (!@#$%...)"),
+)
+
 class ServidorBancario:
-    """Servidor bancario - Una petición por conexión"""
+    """Servidor bancario - Varias peticiones por conexión"""
     
     def __init__(self, host: str = None, port: int = None):
         self.host = host or Config.SERVER_HOST
@@ -40,19 +109,49 @@ class ServidorBancario:
         self.autenticacion = Autenticacion(self.db)
         self.transacciones = GestorTransacciones(self.db)
         
+        # Trazas completas de errores inesperados (máx. 10/s)
+        self._limitador_trazas = LimitadorTrazas(10)
+        
+        # Tipo de mensaje -> manejador (una búsqueda por petición)
+        self._manejadores = {
+            Mensaje.REGISTRO: self._procesar_registro,
+            Mensaje.LOGIN: self._procesar_login,
+            Mensaje.TRANSACCION: self._procesar_transaccion,
+        }
+        
         # Socket
         self.socket_servidor: Optional[socket.socket] = None
         self.activo = False
+        # Se activa tras listen(): quien arranca el servidor en otro hilo
+        # puede esperar a que acepte conexiones sin sondear el puerto
+        self.listo = threading.Event()
+        
+        # Pool acotado de hilos para clientes (un hilo por conexión activa)
+        self._hilos_clientes = Config.MAX_WORKERS
+        self._pool_clientes = ThreadPoolExecutor(
+            max_workers=self._hilos_clientes,
+            thread_name_prefix="cliente"
+        )
+        # Conexiones abiertas: detener() las cierra para liberar los hilos
+        # del pool, que no son daemon y bloquearían la salida del proceso
+        self._conexiones: set[socket.socket] = set()
+        # Aceptadas y aún no cerradas (atendidas + en cola del pool)
+        self._conexiones_abiertas = 0
+        self._lock_conexiones = threading.Lock()
+        
+        # Limpieza periódica de NONCEs (fuera del camino de las peticiones)
+        self._parar_limpieza = threading.Event()
         
         # ✅ Protección anti-fuerza bruta en SERVIDOR
-        self.intentos_login = defaultdict(lambda: {
-            "intentos": 0,
-            "bloqueado_hasta": None,
-            "ultimo_intento": None
-        })
+        # Estado por usuario en diccionarios paralelos, con instantes en
+        # segundos de time.monotonic(); un lock porque cada cliente es un hilo
+        self._intentos_fallidos: dict[str, int] = {}
+        self._bloqueado_hasta: dict[str, float] = {}
+        self._ultimo_intento: dict[str, float] = {}
+        self._lock_intentos = threading.Lock()
         self.MAX_INTENTOS_LOGIN = 5
-        self.TIEMPO_BLOQUEO = timedelta(minutes=15)
-        self.VENTANA_INTENTOS = timedelta(minutes=5)
+        self.TIEMPO_BLOQUEO = 15 * 60  # segundos
+        self.VENTANA_INTENTOS = 5 * 60  # segundos
         # Registrar manejador de señales
         signal.signal(signal.SIGINT, self._signal_handler)
         if hasattr(signal, 'SIGBREAK'):
@@ -72,14 +171,25 @@ class ServidorBancario:
             self.socket_servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket_servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             
-            # Configurar timeout
-            self.socket_servidor.settimeout(1.0)
+            # No bloqueante: accept() solo se llama cuando el selector avisa
+            self.socket_servidor.setblocking(False)
+            
+            # Par de sockets para despertar al selector desde detener()
+            self._despertador_lectura, self._despertador_escritura = socket.socketpair()
             
             # Bind y listen
             self.socket_servidor.bind((self.host, self.port))
             self.socket_servidor.listen(5)
             
             self.activo = True
+            self.listo.set()
+            
+            self._parar_limpieza.clear()
+            threading.Thread(
+                target=self._limpiar_nonces_periodicamente,
+                name="limpieza-nonces",
+                daemon=True
+            ).start()
             
             logger.info("=" * 60)
             logger.info("")
@@ -88,7 +198,7 @@ class ServidorBancario:
             logger.info("=" * 60)
             logger.info("[OK] Clave compartida cargada correctamente")
             logger.info("[OK] Base de datos inicializada")
-            logger.info("[OK] Modo: UNA PETICION POR CONEXION")
+            logger.info("[OK] Modo: CONEXION PERSISTENTE")
             logger.info("[*] Esperando conexiones de clientes...")
             logger.info("[*] Presiona Ctrl+C para detener\n")
             
@@ -99,27 +209,63 @@ class ServidorBancario:
             logger.error(f"[ERROR] Error al iniciar servidor: {e}")
             raise
     
+    def _limpiar_nonces_periodicamente(self):
+        """Borra los NONCEs caducados cada INTERVALO_LIMPIEZA_NONCES segundos"""
+        while not self._parar_limpieza.wait(INTERVALO_LIMPIEZA_NONCES):
+            try:
+                eliminados = self.db.limpiar_nonces_expirados(LOTE_LIMPIEZA_NONCES)
+                if eliminados:
+                    logger.info("[OK] %d NONCEs caducados eliminados", eliminados)
+            except Exception as e:
+                logger.error("[ERROR] Error limpiando NONCEs: %s", e)
+        self.db.cerrar()
+    
     def _aceptar_conexiones(self):
         """Acepta conexiones entrantes (loop principal)"""
         contador_conexiones = 0
         
+        # Sin timeout: el hilo duerme hasta que llega una conexión o
+        # detener() escribe en el despertador
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket_servidor, selectors.EVENT_READ)
+        selector.register(self._despertador_lectura, selectors.EVENT_READ)
+        
         while self.activo:
             try:
-                # Aceptar conexión
-                conn, addr = self.socket_servidor.accept()
-                contador_conexiones += 1
-                logger.info(f"[IN] Conexion #{contador_conexiones} desde {addr}")
-                
-                # Crear thread para manejar el cliente
-                thread = threading.Thread(
-                    target=self._manejar_cliente,
-                    args=(conn, addr, contador_conexiones),
-                    daemon=True
-                )
-                thread.start()
-                
-            except socket.timeout:
-                continue
+                for clave, _ in selector.select():
+                    if clave.fileobj is not self.socket_servidor:
+                        continue  # Despertador: se vuelve a comprobar self.activo
+                    
+                    # Aceptar conexión
+                    try:
+                        conn, addr = self.socket_servidor.accept()
+                    except BlockingIOError:
+                        continue  # El cliente cerró antes de aceptarla
+                    conn.setblocking(True)
+                    contador_conexiones += 1
+                    logger.info("[IN] Conexion #%d desde %s", contador_conexiones, addr)
+                    
+                    # Cada conexión persistente ocupa un hilo hasta que se cierra o
+                    # pasa CLIENT_IDLE_TIMEOUT sin peticiones: con el pool lleno, las
+                    # nuevas esperan en cola a que se libere uno, y por encima de
+                    # MAX_CONEXIONES se rechazan en lugar de esperar sin respuesta
+                    with self._lock_conexiones:
+                        abiertas = self._conexiones_abiertas
+                        if abiertas < Config.MAX_CONEXIONES:
+                            self._conexiones_abiertas += 1
+                    if abiertas >= Config.MAX_CONEXIONES:
+                        logger.warning("[WARNING] #%d rechazada: %d conexiones abiertas (max. %d)",
+                                       contador_conexiones, abiertas, Config.MAX_CONEXIONES)
+                        self._rechazar_conexion(conn)
+                        continue
+                    if abiertas >= self._hilos_clientes:
+                        logger.warning("[WARNING] #%d en cola: los %d hilos del pool estan ocupados",
+                                       contador_conexiones, self._hilos_clientes)
+                    
+                    # Atender al cliente en el pool (espera en cola si está lleno)
+                    self._pool_clientes.submit(
+                        self._manejar_cliente, conn, addr, contador_conexiones
+                    )
                 
             except KeyboardInterrupt:
                 logger.info("\n[WARNING] Interrupcion del teclado")
@@ -133,65 +279,154 @@ class ServidorBancario:
             except Exception as e:
                 if self.activo:
                     logger.error(f"[ERROR] Error aceptando conexion: {e}")
+        
+        selector.close()
+        self._despertador_lectura.close()
+        self._despertador_escritura.close()
+    
+    def _rechazar_conexion(self, conn: socket.socket):
+        """Responde "Servidor ocupado" y cierra (el cliente lo recibe como respuesta)"""
+        try:
+            conn.settimeout(1)
+            self._enviar_error(conn, "Servidor ocupado, intentalo mas tarde")
+        finally:
+            conn.close()
     
     def _manejar_cliente(self, conn: socket.socket, addr: tuple, num_conn: int):
+        """Atiende peticiones de una conexión hasta que el cliente la cierra"""
         try:
-            logger.info(f"[IN] Conexion #{num_conn} desde {addr}")
-            # Recibir datos
-            datos = conn.recv(4096)
-            
-            if not datos:
-                logger.warning(f"[WARNING] {addr} - Conexion cerrada sin datos")
-                return
-            
-            logger.debug(f"[*] #{num_conn} Recibidos {len(datos)} bytes")
-            
-            # Desempaquetar mensaje
-            try:
-                mensaje_bytes, mac, nonce = Mensaje.desempaquetar(datos)
-            except Exception as e:
-                logger.error(f"[ERROR] {addr} - Error al desempaquetar: {e}")
-                self._enviar_error(conn, "Mensaje malformado")
-                return
-            
-            # Validar integridad (MAC + NONCE)
-            try:
-                verificar_mensaje_completo(
-                    db_manager=self.db,
-                    clave=self.clave_compartida,
-                    mensaje=mensaje_bytes,
-                    nonce=nonce,
-                    mac_recibido=mac
-                )
-            except MensajeInvalido as e:
-                logger.warning(f"[ALERT] {addr} - Mensaje rechazado: {e}")
-                self._enviar_error(conn, str(e))
-                return
-            
-            # Parsear mensaje
-            mensaje = Mensaje.desde_json(mensaje_bytes)
-            logger.info(f"[OK] #{num_conn} - Tipo: {mensaje.tipo}")
-            
-            # Procesar según tipo
-            if mensaje.tipo == Mensaje.REGISTRO:
-                self._procesar_registro(conn, mensaje, addr)
-            
-            elif mensaje.tipo == Mensaje.LOGIN:
-                self._procesar_login(conn, mensaje, addr)
-            
-            elif mensaje.tipo == Mensaje.TRANSACCION:
-                self._procesar_transaccion(conn, mensaje, addr)
-            
-            else:
-                logger.warning(f"[WARNING] {addr} - Tipo desconocido: {mensaje.tipo}")
-                self._enviar_error(conn, "Tipo de mensaje no soportado")
+            logger.info("[IN] Conexion #%d desde %s", num_conn, addr)
+            with self._lock_conexiones:
+                self._conexiones.add(conn)
+            # Cada respuesta es una escritura pequeña: sin Nagle no espera
+            # al ACK retardado del cliente antes de salir
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Un cliente inactivo no retiene indefinidamente un hilo del pool
+            conn.settimeout(Config.CLIENT_IDLE_TIMEOUT)
+            while self.activo:
+                # Recibir una trama completa
+                try:
+                    datos = recibir_trama(conn)
+                except ValueError as e:
+                    # Cabecera corrupta: el flujo ya no se puede resincronizar
+                    logger.error("[ERROR] %s - Trama invalida: %s", addr, e)
+                    self._enviar_error(conn, "Mensaje malformado")
+                    break
+                
+                if datos is None:
+                    logger.debug("[*] #%d Cliente cerro la conexion", num_conn)
+                    break
+                
+                logger.debug("[*] #%d Recibidos %d bytes", num_conn, len(datos))
+                self._procesar_peticion(conn, datos, addr, num_conn)
+        
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logger.debug("[*] #%d Conexion perdida: %s", num_conn, e)
+        
+        except socket.timeout:
+            logger.info("[CLOSE] #%d Conexion inactiva durante %.0f s",
+                        num_conn, Config.CLIENT_IDLE_TIMEOUT)
         
         except Exception as e:
-            logger.error(f"[ERROR] {addr} - Error: {e}", exc_info=True)
+            logger.error("[ERROR] %s - Error: %s", addr, e,
+                         exc_info=self._limitador_trazas.permitir())
         
         finally:
+            with self._lock_conexiones:
+                self._conexiones.discard(conn)
+                self._conexiones_abiertas -= 1
             conn.close()
-            logger.debug(f"[CLOSE] #{num_conn} - Conexion cerrada")
+            logger.debug("[CLOSE] #%d - Conexion cerrada", num_conn)
+    
+    def _procesar_peticion(self, conn: socket.socket, datos: bytes, addr: tuple, num_conn: int):
+        """Valida y procesa UNA petición recibida por la conexión"""
+        # Desempaquetar mensaje
+        try:
+            formato, mensaje_bytes, mac, nonce = Mensaje.desempaquetar(datos)
+        except Exception as e:
+            logger.error("[ERROR] %s - Error al desempaquetar: %s", addr, e)
+            self._enviar_error(conn, "Mensaje malformado")
+            return
+        
+        # Validar integridad (MAC + NONCE)
+        try:
+            verificar_mensaje_completo(
+                db_manager=self.db,
+                clave=self.clave_compartida,
+                mensaje=mensaje_bytes,
+                nonce=nonce,
+                mac_recibido=mac
+            )
+        except MensajeInvalido as e:
+            logger.warning("[ALERT] %s - Mensaje rechazado: %s", addr, e)
+            self._enviar_error(conn, str(e), formato)
+            return
+        
+        # Parsear mensaje
+        mensaje = Mensaje.desde_bytes(mensaje_bytes, formato)
+        logger.info("[OK] #%d - Tipo: %s", num_conn, mensaje.tipo)
+        
+        if mensaje.tipo == Mensaje.LOTE:
+            respuesta = self._procesar_lote(mensaje, addr)
+        else:
+            respuesta = self._despachar(mensaje, addr)
+        
+        # Se contesta en el mismo formato que usó el cliente
+        self._enviar_respuesta(conn, respuesta, formato)
+    
+    def _despachar(self, mensaje: Mensaje, addr: tuple) -> dict:
+        """Procesa un mensaje ya validado y devuelve la respuesta"""
+        manejador = self._manejadores.get(mensaje.tipo)
+        if manejador is None:
+            logger.warning("[WARNING] %s - Tipo desconocido: %s", addr, mensaje.tipo)
+            return self._error("Tipo de mensaje no soportado")
+        
+        return manejador(mensaje, addr)
+    
+    def _procesar_lote(self, mensaje: Mensaje, addr: tuple) -> dict:
+        """
+        Procesa varias operaciones que llegaron bajo un único MAC/NONCE
+        Devuelve una sola respuesta con la lista de respuestas (mismo orden)
+        """
+        items = mensaje.datos.get("items") if isinstance(mensaje.datos, dict) else None
+        
+        if not isinstance(items, list) or not items:
+            return self._error("Lote vacio o malformado")
+        
+        if len(items) > MAX_ITEMS_LOTE:
+            return self._error(f"Lote demasiado grande (maximo {MAX_ITEMS_LOTE})")
+        
+        respuestas = []
+        operaciones_argon2 = 0
+        for item in items:
+            # tipo se busca en _manejadores y los manejadores leen los campos
+            # con datos.get(): cualquier otra cosa es un elemento malformado
+            if not (isinstance(item, dict)
+                    and isinstance(item.get("tipo"), str)
+                    and isinstance(item.get("datos"), dict)):
+                respuestas.append(self._error("Elemento del lote malformado"))
+                continue
+            sub_mensaje = Mensaje(item["tipo"], item["datos"])
+            
+            # No se permiten lotes anidados
+            if sub_mensaje.tipo == Mensaje.LOTE:
+                respuestas.append(self._error("Tipo de mensaje no soportado"))
+                continue
+            
+            # Registro y login calculan un hash Argon2 cada uno
+            if sub_mensaje.tipo in (Mensaje.REGISTRO, Mensaje.LOGIN):
+                operaciones_argon2 += 1
+                if operaciones_argon2 > MAX_ARGON2_LOTE:
+                    respuestas.append(self._error(
+                        f"Demasiados registros/logins en el lote (maximo {MAX_ARGON2_LOTE})"
+                    ))
+                    continue
+            
+            respuestas.append(self._despachar(sub_mensaje, addr))
+        
+        return self._ok(f"Lote procesado: {len(respuestas)} operaciones", {
+            "respuestas": respuestas
+        })
     
     def _validar_password(self, password: str) -> tuple[bool, str]:
         """Valida fortaleza de contraseña"""
@@ -202,97 +437,98 @@ class ServidorBancario:
         if password.strip() == "":
             return False, "La contraseña no puede estar vacía"
         
-        if not re.search(r'[A-Z]', password):
-            return False, "Debe contener al menos una letra mayúscula (A-Z)"
-        
-        if not re.search(r'[a-z]', password):
-            return False, "Debe contener al menos una letra minúscula (a-z)"
-        
-        if not re.search(r'[0-9]', password):
-            return False, "Debe contener al menos un número (0-9)"
-        
-        if not re.search(r'[!@#$%^&*(),.?":{}|<>_\-+=\[\]\\\/~`]', password):
-            return False, "Debe contener al menos un carácter especial (!@#$%...)"
+        # Se recorre la contraseña entera y se evalúan todos los requisitos,
+        # para que el tiempo no dependa de qué clases de caracteres faltan
+        presentes = set(password.encode('utf-8').translate(_CLASES_CARACTER))
+        fallos = [mensaje for clase, mensaje in REQUISITOS_PASSWORD
+                  if clase not in presentes]
+        if fallos:
+            return False, fallos[0]
         
         return True, ""
     
-    def _procesar_registro(self, conn, mensaje, addr):
+    def _procesar_registro(self, mensaje, addr) -> dict:
         username = mensaje.datos.get("username")
         password = mensaje.datos.get("password")
         
         if not username or not password:
-            self._enviar_error(conn, "Faltan datos de registro")
-            return
+            return self._error("Faltan datos de registro")
         
         # ✅ Validar fortaleza
         password_valida, error_msg = self._validar_password(password)
         
         if not password_valida:
-            self._enviar_error(conn, error_msg)
-            return
+            return self._error(error_msg)
         
         exito, msg = self.autenticacion.registrar(username, password)
         
         if exito:
-            self._enviar_ok(conn, msg)
+            return self._ok(msg)
         else:
-            self._enviar_error(conn, msg)
+            return self._error(msg)
     
-    def _procesar_login(self, conn, mensaje, addr):
+    def _procesar_login(self, mensaje, addr) -> dict:
         username = mensaje.datos.get("username")
         password = mensaje.datos.get("password")
         
         if not username or not password:
-            self._enviar_error(conn, "Faltan credenciales")
-            return
+            return self._error("Faltan credenciales")
         
         exito, msg = self.autenticacion.login(username, password)
         
         if exito:
-            self._enviar_ok(conn, msg)
+            return self._ok(msg)
         else:
-            self._enviar_error(conn, msg)
+            return self._error(msg)
     
-    def _procesar_transaccion(self, conn, mensaje, addr):
+    def _procesar_transaccion(self, mensaje, addr) -> dict:
         username = mensaje.datos.get("username")
         cuenta_origen = mensaje.datos.get("cuenta_origen")
         cuenta_destino = mensaje.datos.get("cuenta_destino")
         cantidad = mensaje.datos.get("cantidad")
         
-        if not all([username, cuenta_origen, cuenta_destino, cantidad]):
-            self._enviar_error(conn, "Faltan datos de la transaccion")
-            return
+        # cantidad se compara con None: 0.0 es un valor presente, no un dato ausente
+        if not (username and cuenta_origen and cuenta_destino) or cantidad is None:
+            return self._error("Faltan datos de la transaccion")
         
         exito, msg = self.transacciones.procesar_transferencia(
             username, cuenta_origen, cuenta_destino, cantidad
         )
         
         if exito:
-            self._enviar_ok(conn, msg)
+            return self._ok(msg)
         else:
-            self._enviar_error(conn, msg)
+            return self._error(msg)
     
-    def _enviar_ok(self, conn, mensaje, datos=None):
-        respuesta = {
+    def _ok(self, mensaje, datos=None) -> dict:
+        return {
             "status": "ok",
             "mensaje": mensaje,
             "datos": datos or {}
         }
-        self._enviar_respuesta(conn, respuesta)
     
-    def _enviar_error(self, conn, mensaje):
-        respuesta = {
+    def _error(self, mensaje) -> dict:
+        return {
             "status": "error",
             "mensaje": mensaje
         }
-        self._enviar_respuesta(conn, respuesta)
     
-    def _enviar_respuesta(self, conn, respuesta):
+    def _enviar_respuesta(self, conn, respuesta: dict, formato: int = FORMATO_JSON):
+        """
+        Envía una respuesta enmarcada
+        Sin formato conocido (paquete ilegible) se usa JSON: todo cliente lo entiende
+        """
+        try:
+            conn.sendall(enmarcar(empaquetar_respuesta(respuesta, formato)))
+        except Exception as e:
+            logger.error("[ERROR] Error enviando respuesta: %s", e)
+    
+    def _enviar_error(self, conn, mensaje: str, formato: int = FORMATO_JSON):
+        """Envía una respuesta de error de texto fijo (trama precalculada)"""
         try:
-            datos = json.dumps(respuesta).encode('utf-8')
-            conn.sendall(datos)
+            conn.sendall(_trama_error(mensaje, formato))
         except Exception as e:
-            logger.error(f"[ERROR] Error enviando respuesta: {e}")
+            logger.error("[ERROR] Error enviando respuesta: %s", e)
     
     def detener(self):
         if not self.activo:
@@ -300,6 +536,23 @@ class ServidorBancario:
         
         logger.info("[STOP] Deteniendo servidor...")
         self.activo = False
+        self.listo.clear()
+        self._parar_limpieza.set()
+        self._pool_clientes.shutdown(wait=False, cancel_futures=True)
+        
+        # Despertar al hilo que espera en el selector
+        try:
+            self._despertador_escritura.send(b"\0")
+        except (AttributeError, OSError):
+            pass  # Servidor no iniciado o bucle ya terminado
+        
+        # Despertar a los hilos bloqueados en recv() (reciben EOF)
+        with self._lock_conexiones:
+            for conn in self._conexiones:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
         
         if self.socket_servidor:
             try:
@@ -309,95 +562,106 @@ class ServidorBancario:
         
         logger.info("[OK] Servidor detenido correctamente")
 
-    def _verificar_rate_limit_login(self, username: str) -> tuple[bool, str]:
+    def _reservar_intento_login(self, username: str) -> tuple[bool, str, int]:
         """
-        Verifica si el usuario está bloqueado por demasiados intentos
+        Comprueba el bloqueo y reserva el intento en una sola sección crítica
+        
+        El intento cuenta como fallido desde antes de verificar la contraseña
+        (Argon2 se ejecuta fuera del lock): con MAX_INTENTOS_LOGIN intentos
+        fallidos o en curso, los siguientes se rechazan sin llegar a Argon2.
+        Un login correcto deshace la reserva en _registrar_intento_login.
         
         Returns:
-            tuple[bool, str]: (puede_intentar, mensaje_error)
+            tuple[bool, str, int]: (puede_intentar, mensaje_error, intentos
+            acumulados contando este)
         """
-        ahora = datetime.now()
-        estado = self.intentos_login[username]
-        
-        # Verificar si está bloqueado
-        if estado["bloqueado_hasta"] and ahora < estado["bloqueado_hasta"]:
-            tiempo_restante = estado["bloqueado_hasta"] - ahora
-            minutos = int(tiempo_restante.total_seconds() / 60) + 1
-            return False, f"Usuario bloqueado. Intenta en {minutos} minuto(s)"
-        
-        # Si el bloqueo expiró, resetear
-        if estado["bloqueado_hasta"] and ahora >= estado["bloqueado_hasta"]:
-            estado["intentos"] = 0
-            estado["bloqueado_hasta"] = None
-        
-        # Resetear contador si pasó la ventana de tiempo
-        if estado["ultimo_intento"]:
-            tiempo_desde_ultimo = ahora - estado["ultimo_intento"]
-            if tiempo_desde_ultimo > self.VENTANA_INTENTOS:
-                estado["intentos"] = 0
+        ahora = time.monotonic()
+        with self._lock_intentos:
+            bloqueado_hasta = self._bloqueado_hasta.get(username)
+            
+            # Verificar si está bloqueado
+            if bloqueado_hasta is not None:
+                if ahora < bloqueado_hasta:
+                    minutos = int((bloqueado_hasta - ahora) / 60) + 1
+                    return False, f"Usuario bloqueado. Intenta en {minutos} minuto(s)", 0
+                
+                # El bloqueo expiró: resetear
+                del self._bloqueado_hasta[username]
+                self._intentos_fallidos.pop(username, None)
+            
+            # Resetear contador si pasó la ventana de tiempo
+            ultimo = self._ultimo_intento.get(username)
+            if ultimo is not None and ahora - ultimo > self.VENTANA_INTENTOS:
+                self._intentos_fallidos.pop(username, None)
+            
+            # Límite alcanzado con intentos aún en curso: el bloqueo es inminente
+            intentos = self._intentos_fallidos.get(username, 0)
+            if intentos >= self.MAX_INTENTOS_LOGIN:
+                return False, "Usuario bloqueado: demasiados intentos fallidos", intentos
+            
+            # Reservar el intento
+            intentos += 1
+            self._intentos_fallidos[username] = intentos
+            self._ultimo_intento[username] = ahora
         
-        return True, ""
+        return True, "", intentos
 
     def _registrar_intento_login(self, username: str, exitoso: bool):
-        """Registra un intento de login (exitoso o fallido)"""
-        ahora = datetime.now()
-        estado = self.intentos_login[username]
-        
-        if exitoso:
-            # Login exitoso: resetear contador
-            estado["intentos"] = 0
-            estado["bloqueado_hasta"] = None
-            estado["ultimo_intento"] = ahora
-        else:
-            # Login fallido: incrementar contador
-            estado["intentos"] += 1
-            estado["ultimo_intento"] = ahora
+        """
+        Registra el resultado de un intento reservado con _reservar_intento_login
+        
+        Un login correcto resetea el contador (deshace la reserva); uno
+        fallido ya está contado y bloquea al usuario si se llegó al límite
+        """
+        ahora = time.monotonic()
+        with self._lock_intentos:
+            if exitoso:
+                self._intentos_fallidos.pop(username, None)
+                self._bloqueado_hasta.pop(username, None)
+                return
             
             # Bloquear si alcanzó el límite
-            if estado["intentos"] >= self.MAX_INTENTOS_LOGIN:
-                estado["bloqueado_hasta"] = ahora + self.TIEMPO_BLOQUEO
-                logger.warning(
-                    f"🚨 [BRUTE_FORCE] Usuario '{username}' bloqueado "
-                    f"por {self.MAX_INTENTOS_LOGIN} intentos fallidos"
-                )
+            intentos = self._intentos_fallidos.get(username, 0)
+            if intentos < self.MAX_INTENTOS_LOGIN or username in self._bloqueado_hasta:
+                return
+            self._bloqueado_hasta[username] = ahora + self.TIEMPO_BLOQUEO
+        
+        logger.warning("[BRUTE_FORCE] Usuario '%s' bloqueado por %d intentos fallidos",
+                       username, self.MAX_INTENTOS_LOGIN)
 
-    def _procesar_login(self, conn, mensaje, addr):
+    def _procesar_login(self, mensaje, addr) -> dict:
         """Procesa solicitud de login CON protección anti-fuerza bruta"""
         username = mensaje.datos.get("username")
         password = mensaje.datos.get("password")
         
         if not username or not password:
-            self._enviar_error(conn, "Faltan credenciales")
-            return
+            return self._error("Faltan credenciales")
         
-        # ✅ VERIFICAR RATE LIMIT
-        puede_intentar, mensaje_error = self._verificar_rate_limit_login(username)
+        # ✅ VERIFICAR RATE LIMIT Y RESERVAR EL INTENTO
+        puede_intentar, mensaje_error, intentos = self._reservar_intento_login(username)
         
         if not puede_intentar:
-            logger.warning(f"🚨 [BLOCKED] Intento de login bloqueado: {username} desde {addr}")
-            self._enviar_error(conn, mensaje_error)
-            return
+            logger.warning("[BLOCKED] Intento de login bloqueado: %s desde %s", username, addr)
+            return self._error(mensaje_error)
         
         # Procesar login
         exito, msg = self.autenticacion.login(username, password)
         
-        # ✅ REGISTRAR INTENTO
+        # ✅ REGISTRAR RESULTADO
         self._registrar_intento_login(username, exito)
         
         if exito:
-            self._enviar_ok(conn, msg)
+            return self._ok(msg)
         else:
             # Informar intentos restantes
-            estado = self.intentos_login[username]
-            restantes = self.MAX_INTENTOS_LOGIN - estado["intentos"]
+            restantes = self.MAX_INTENTOS_LOGIN - intentos
             
             if restantes > 0:
                 msg_completo = f"{msg}. Intentos restantes: {restantes}"
             else:
-                msg_completo = f"{msg}. Usuario bloqueado por {int(self.TIEMPO_BLOQUEO.total_seconds() / 60)} minutos"
+                msg_completo = f"{msg}. Usuario bloqueado por {self.TIEMPO_BLOQUEO // 60} minutos"
             
-            self._enviar_error(conn, msg_completo)
-
+            return self._error(msg_completo)
 
 def main():
     import sys
@@ -405,13 +669,14 @@ def main():
     
     Path("logs").mkdir(exist_ok=True)
     
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
+    # Un fallo al escribir un log no debe propagarse a las peticiones
+    logging.raiseExceptions = False
+    configurar_logging_basico(
         handlers=[
             logging.FileHandler('logs/servidor.log', encoding='utf-8'),
             logging.StreamHandler(sys.stdout)
-        ]
+        ],
+        en_segundo_plano=True
     )
     
     servidor = ServidorBancario()
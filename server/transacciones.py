@@ -1,10 +1,29 @@
 import logging
-from typing import Tuple
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Optional, Tuple
 
 from server.database import DatabaseManager
 
 logger = logging.getLogger(__name__)
 
+def a_centimos(cantidad) -> int:
+    """
+    Convierte un importe en euros (float/str/Decimal) a céntimos enteros
+    
+    Decimal(str(...)) evita arrastrar el error binario del float
+    (100.5 -> 10050, no 10049)
+    
+    Raises:
+        ValueError: Si la cantidad no es un número finito
+    """
+    try:
+        euros = Decimal(str(cantidad))
+    except ArithmeticError:
+        raise ValueError(f"Cantidad no numérica: {cantidad!r}")
+    if not euros.is_finite():
+        raise ValueError(f"Cantidad no finita: {cantidad!r}")
+    return int((euros * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
 class GestorTransacciones:
     """Gestiona las transacciones bancarias"""
     
@@ -35,41 +54,52 @@ class GestorTransacciones:
             Solo se registra la transacción.
         """
         try:
+            # Euros -> céntimos una sola vez, en la frontera
+            cantidad_cents = a_centimos(cantidad)
+            
             # Registrar transacción en BD
             tx_id = self.db.registrar_transaccion(
                 username=username,
                 cuenta_origen=cuenta_origen,
                 cuenta_destino=cuenta_destino,
-                cantidad=cantidad,
+                cantidad_cents=cantidad_cents,
                 mac_verificado=True  # Ya se verificó antes de llegar aquí
             )
             
             logger.info(
-                f"[OK] Transacción registrada (ID: {tx_id}): "
-                f"{username} → {cantidad:.2f} EUR "
-                f"({cuenta_origen} → {cuenta_destino})"
+                "[OK] Transacción registrada (ID: %s): %s → %.2f EUR (%s → %s)",
+                tx_id, username, cantidad_cents / 100, cuenta_origen, cuenta_destino
             )
             
             return True, f"Transferencia completada (ID: {tx_id})"
             
         except Exception as e:
-            logger.error(f"[ERROR] Error al procesar transferencia: {e}")
+            logger.error("[ERROR] Error al procesar transferencia: %s", e)
             return False, "Error al procesar la transferencia"
     
-    def obtener_transacciones(self, username: str) -> list:
+    def obtener_transacciones(
+        self,
+        username: str,
+        limite: Optional[int] = None,
+        desplazamiento: int = 0
+    ) -> list:
         """
         Obtiene las transacciones de un usuario
         
         Args:
             username: Usuario
+            limite: Máximo de transacciones (None = todas)
+            desplazamiento: Transacciones a saltar (paginación)
         
         Returns:
             list: Lista de transacciones
         """
         try:
-            transacciones = self.db.obtener_transacciones_usuario(username)
-            logger.info(f"[OK] Consultadas {len(transacciones)} transacciones de {username}")
+            transacciones = self.db.obtener_transacciones_usuario(
+                username, limite, desplazamiento
+            )
+            logger.info("[OK] Consultadas %d transacciones de %s", len(transacciones), username)
             return transacciones
         except Exception as e:
-            logger.error(f"[ERROR] Error al obtener transacciones: {e}")
+            logger.error("[ERROR] Error al obtener transacciones: %s", e)
             return []
\ No newline at end of file
@@ -0,0 +1,213 @@
+# tests/conftest.py
+"""
+Fixtures compartidas por todos los módulos de tests
+"""
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import pytest
+
+from server import crypto_server
+from server.server import ServidorBancario
+from client.communicacion import ClienteSocket
+from common.config import Config
+from common.protocolo import Mensaje
+
+# pytest-xdist es opcional: sin él solo hay un proceso ("master")
+try:
+    import xdist  # noqa: F401
+except ImportError:
+    @pytest.fixture(scope="session")
+    def worker_id():
+        """Fixture: Identificador del proceso de tests (sin pytest-xdist)"""
+        return "master"
+
+# pytest-socket es opcional: si está instalado, los tests solo pueden
+# conectar con 127.0.0.1 (una conexión a otro host falla al momento en
+# lugar de esperar a un timeout de red)
+try:
+    import pytest_socket  # noqa: F401
+except ImportError:
+    pytest_socket = None
+
+# Puerto base del servidor de pruebas (el real usa Config.SERVER_PORT)
+PUERTO_BASE_TEST = 5001
+
+# Usuarios pre-registrados por sesión (uno por test que saca uno del pool)
+TAM_POOL_USUARIOS = 5
+PASSWORD_POOL = "Correct_pass1!"
+
+
+# Sufijo de nombres únicos: contador del proceso (int(time.time()) se repite
+# si dos tests usan el mismo prefijo en el mismo segundo)
+_contador_nombres = itertools.count()
+
+
+def _puerto_para_worker(worker_id: str) -> int:
+    """
+    Puerto del servidor de pruebas para cada proceso de pytest-xdist
+
+    "master" → 5001, "gw0" → 5002, "gw1" → 5003...
+    (no se usa hash(): cambia entre procesos con PYTHONHASHSEED)
+    """
+    if worker_id == "master":
+        return PUERTO_BASE_TEST
+    return PUERTO_BASE_TEST + 1 + int(worker_id.lstrip("gw"))
+
+
+def _ruta_bd_test(tmp_path_factory, worker_id: str) -> str:
+    """
+    BD del servidor de pruebas para cada proceso de pytest-xdist
+
+    En memoria con el VFS memdb (SQLite >= 3.36): todas las conexiones del
+    proceso ven la misma BD, con bloqueos normales (busy_timeout funciona,
+    a diferencia de cache=shared). Con SQLite más antiguo, fichero temporal
+    """
+    if sqlite3.sqlite_version_info >= (3, 36, 0):
+        return f"file:/bank_{worker_id}?vfs=memdb"
+    return str(tmp_path_factory.mktemp(f"db_{worker_id}") / "bank.db")
+
+
+# ════════════════════════════════════════════════════════
+# HOOKS
+# ════════════════════════════════════════════════════════
+
+def pytest_collection_modifyitems(items):
+    """Con pytest-socket, limita las conexiones de cada test a 127.0.0.1"""
+    if pytest_socket is None:
+        return
+    for item in items:
+        if item.get_closest_marker("allow_hosts") is None:
+            item.add_marker(pytest.mark.allow_hosts(["127.0.0.1"]))
+
+
+# ════════════════════════════════════════════════════════
+# FIXTURES
+# ════════════════════════════════════════════════════════
+
+@pytest.fixture(scope="session")
+def servidor_test(tmp_path_factory, worker_id):
+    """
+    Fixture: Servidor de prueba con logging
+
+    Uno por sesión (por proceso con pytest-xdist), con su propia BD
+    en memoria para no tocar database/usuarios.db ni chocar con otros workers
+    """
+    # Crear directorio de logs
+    Path("logs").mkdir(exist_ok=True)
+
+    # Configurar logging ANTES de iniciar el servidor
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            # Log a archivo (para evidencias)
+            logging.FileHandler('logs/test_servidor.log', encoding='utf-8'),
+            # Log a consola (para ver en tiempo real)
+            logging.StreamHandler()
+        ],
+        force=True  # Sobrescribir configuración anterior
+    )
+
+    # Argon2 barato: el registro/login de cada test no paga el coste real
+    test_mode_original = Config.TEST_MODE
+    Config.TEST_MODE = True
+    crypto_server.reconfigurar_argon2()
+
+    # BD y puerto propios de este worker
+    db_path_original = Config.DB_PATH
+    Config.DB_PATH = _ruta_bd_test(tmp_path_factory, worker_id)
+    puerto = _puerto_para_worker(worker_id)
+    # Una BD memdb se borra al cerrarse su última conexión: esta la mantiene
+    # viva toda la sesión aunque los hilos del servidor cierren las suyas
+    conexion_ancla = sqlite3.connect(Config.DB_PATH, uri=Config.DB_PATH.startswith("file:"))
+
+    servidor = ServidorBancario(host="127.0.0.1", port=puerto)
+
+    # Iniciar en thread separado (no daemon: al final se espera a que termine)
+    thread = threading.Thread(target=servidor.iniciar, name="servidor-test")
+    thread.start()
+
+    # Esperar a que el servidor esté escuchando (listo se activa tras listen())
+    if not servidor.listo.wait(timeout=5):
+        servidor.detener()
+        pytest.fail("Servidor no se inició correctamente")
+
+    print(f"\n[TEST] Servidor de prueba iniciado en puerto {puerto}")
+
+    yield servidor
+
+    # Cleanup: Detener servidor
+    servidor.detener()
+    thread.join(timeout=5)
+    conexion_ancla.close()
+    Config.DB_PATH = db_path_original
+    Config.TEST_MODE = test_mode_original
+    crypto_server.reconfigurar_argon2()
+    print("\n[TEST] Servidor de prueba detenido")
+    assert not thread.is_alive(), "El hilo del servidor no terminó tras detener()"
+
+
+@pytest.fixture(scope="session")
+def db_servidor(servidor_test):
+    """
+    Fixture: El DatabaseManager del servidor de pruebas
+
+    Los tests que comprueban la BD lo reutilizan en lugar de abrir otro;
+    cada hilo usa su propia conexión, así que las lecturas del test no
+    comparten conexión con los hilos que atienden a los clientes
+    """
+    return servidor_test.db
+
+
+@pytest.fixture(scope="session")
+def nombre_unico():
+    """
+    Fixture: Genera nombres de usuario que no se repiten en la sesión
+
+    nombre_unico("test_user") → "test_user_0_<pid>", "test_user_1_<pid>"...
+    El pid distingue los procesos de pytest-xdist
+    """
+    def _nombre(prefijo: str) -> str:
+        return f"{prefijo}_{next(_contador_nombres)}_{os.getpid()}"
+    return _nombre
+
+
+@pytest.fixture(scope="session")
+def usuarios_pool(servidor_test, nombre_unico):
+    """
+    Fixture: Usuarios ya registrados para los tests que solo necesitan
+    "un usuario cualquiera"
+
+    Se registran todos en un único enviar_batch al arrancar la sesión;
+    los tests que prueban el propio registro siguen registrando el suyo
+    """
+    clave = Config.get_shared_key()
+    usernames = [nombre_unico("test_pool") for _ in range(TAM_POOL_USUARIOS)]
+
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
+    respuestas = cliente.enviar_batch([
+        Mensaje(Mensaje.REGISTRO, {"username": u, "password": PASSWORD_POOL}).empaquetar(clave)
+        for u in usernames
+    ])
+    cliente.desconectar()
+
+    assert all(r and r["status"] == "ok" for r in respuestas), "Registro del pool falló"
+    return [(u, PASSWORD_POOL) for u in usernames]
+
+
+@pytest.fixture
+def usuario_registrado(usuarios_pool):
+    """
+    Fixture: Saca un usuario del pool (username, password)
+
+    Cada test recibe uno distinto: puede bloquearlo o llenarlo de
+    transacciones sin afectar a los demás
+    """
+    if not usuarios_pool:
+        pytest.fail("Pool de usuarios agotado: aumentar TAM_POOL_USUARIOS")
+    return usuarios_pool.pop()
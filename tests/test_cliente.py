@@ -1,7 +1,10 @@
+import io
+import socket
 import pytest
 from unittest.mock import Mock, patch
 from client.communicacion import ClienteSocket
 from client.crypto_client import preparar_mensaje_seguro
+from common.protocolo import enmarcar, empaquetar_respuesta, recibir_trama
 from common.crypto__utils import generar_nonce, verificar_mac
 
 def test_preparar_mensaje_seguro():
@@ -39,4 +42,64 @@ def test_cliente_socket_enviar():
         resultado = cliente.enviar(datos)
         
         assert resultado is True
-        cliente.socket.sendall.assert_called_once_with(datos)
\ No newline at end of file
+        cliente.socket.sendall.assert_called_once_with(enmarcar(datos))
+
+def test_cliente_socket_envio_diferido():
+    """Test: Las tramas diferidas salen juntas en un único sendall"""
+    cliente = ClienteSocket()
+    cliente.socket = Mock()
+    
+    assert cliente.enviar(b"uno", vaciar=False)
+    assert cliente.enviar(b"dos", vaciar=False)
+    cliente.socket.sendall.assert_not_called()
+    
+    assert cliente.vaciar()
+    cliente.socket.sendall.assert_called_once_with(enmarcar(b"uno") + enmarcar(b"dos"))
+
+def test_enviar_batch_desconecta_si_falta_respuesta():
+    """Test: Con alguna respuesta ya leída, un corte no se reintenta y se desconecta"""
+    local, remoto = socket.socketpair()
+    cliente = ClienteSocket()
+    cliente.socket = local
+    cliente.conectar = Mock()
+    
+    # El "servidor" contesta a la primera petición y cierra su lado
+    remoto.sendall(enmarcar(empaquetar_respuesta({"status": "ok", "mensaje": "uno"})))
+    remoto.shutdown(socket.SHUT_WR)
+    
+    respuestas = cliente.enviar_batch([b"uno", b"dos"])
+    remoto.close()
+    
+    assert respuestas[0]["mensaje"] == "uno"
+    assert respuestas[1] is None
+    # Sin socket: la siguiente petición no leerá respuestas de este lote
+    assert cliente.socket is None
+    cliente.conectar.assert_not_called()
+
+def test_enmarcar_y_recibir_trama():
+    """Test: Una trama llega completa aunque TCP la entregue por trozos"""
+    paquete = b'{"status":"ok"}' * 500
+    flujo = io.BytesIO(enmarcar(paquete))
+    
+    # Simula un socket que entrega como máximo 100 bytes por recv_into()
+    def recv_into(buffer):
+        trozo = flujo.read(min(len(buffer), 100))
+        buffer[:len(trozo)] = trozo
+        return len(trozo)
+    
+    sock = Mock()
+    sock.recv_into.side_effect = recv_into
+    
+    assert recibir_trama(sock) == paquete
+
+def test_recibir_trama_demasiado_grande():
+    """Test: Una cabecera con longitud absurda se rechaza"""
+    def recv_into(buffer):
+        buffer[:4] = b"BASU"
+        return 4
+    
+    sock = Mock()
+    sock.recv_into.side_effect = recv_into
+    
+    with pytest.raises(ValueError):
+        recibir_trama(sock)
\ No newline at end of file
@@ -1,6 +1,12 @@
+import hashlib
+import hmac
+from unittest.mock import Mock
+
 import pytest
+from common import crypto__utils
 from common.crypto__utils import generar_nonce, calcular_mac, verificar_mac
-from common.constantes import NONCE_SIZE, MAC_SIZE
+from common.constantes import NONCE_SIZE, MAC_SIZE, MAC_BLAKE2B
+from server.crypto_server import verificar_mensaje_completo, MensajeInvalido
 
 def test_generar_nonce():
     """Test: Los NONCEs deben ser únicos"""
@@ -58,4 +64,48 @@ def test_mac_diferente_con_diferente_nonce():
     mac1 = calcular_mac(clave, mensaje, nonce1)
     mac2 = calcular_mac(clave, mensaje, nonce2)
     
-    assert mac1 != mac2  # MACs deben ser diferentes
\ No newline at end of file
+    assert mac1 != mac2  # MACs deben ser diferentes
+
+
+def test_mac_coincide_con_hmac_estandar():
+    """Test: El contexto reutilizado da el mismo MAC que HMAC-SHA256 directo"""
+    mensaje = b"Mensaje repetido"
+    nonce = generar_nonce()
+    
+    for clave in (b"clave_de_prueba_32_bytes_long!@#", b"otra_clave_distinta_32_bytes!!!!"):
+        esperado = hmac.new(clave, mensaje + nonce, hashlib.sha256).digest()
+        # Dos veces: la segunda usa el contexto ya preparado
+        assert calcular_mac(clave, mensaje, nonce) == esperado
+        assert calcular_mac(clave, mensaje, nonce) == esperado
+
+def test_replay_reciente_no_consulta_bd():
+    """Test: Un NONCE reciente se rechaza desde memoria, sin ir a la BD"""
+    clave = b"clave_de_prueba_32_bytes_long!@#"
+    mensaje = b"Transferencia: 100 EUR"
+    nonce = generar_nonce()
+    mac = calcular_mac(clave, mensaje, nonce)
+    
+    db = Mock()
+    db.validar_nonce.return_value = True
+    
+    assert verificar_mensaje_completo(db, clave, mensaje, nonce, mac)
+    
+    with pytest.raises(MensajeInvalido):
+        verificar_mensaje_completo(db, clave, mensaje, nonce, mac)
+    
+    db.validar_nonce.assert_called_once_with(nonce)
+
+def test_mac_blake2b(monkeypatch):
+    """Test: Con MAC_ALGORITHM = BLAKE2b se usa BLAKE2b con clave"""
+    monkeypatch.setattr(crypto__utils, "MAC_ALGORITHM", MAC_BLAKE2B)
+    monkeypatch.setattr(crypto__utils, "_contextos_hmac", {})
+    
+    clave = b"clave_de_prueba_32_bytes_long!@#"
+    mensaje = b"Transferencia: 100 EUR"
+    nonce = generar_nonce()
+    
+    esperado = hashlib.blake2b(mensaje + nonce, key=clave, digest_size=MAC_SIZE).digest()
+    mac = calcular_mac(clave, mensaje, nonce)
+    
+    assert mac == esperado
+    assert verificar_mac(clave, mensaje, nonce, mac)
@@ -1,16 +1,22 @@
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
 import pytest
-from pathlib import Path
+from argon2 import PasswordHasher
+import server.autenticacion as autenticacion
+from server.autenticacion import Autenticacion
 from server.database import DatabaseManager
-from server.crypto_server import hashear_password
+from server.crypto_server import hashear_password, necesita_rehash
 
 @pytest.fixture
-def db():
-    """Fixture: Base de datos temporal para tests"""
-    db_path = "test_db.sqlite"
-    db_manager = DatabaseManager(db_path)
+def db(tmp_path):
+    """Fixture: Base de datos temporal para tests (una por test, en tmp_path)"""
+    db_manager = DatabaseManager(str(tmp_path / "test_db.sqlite"))
     yield db_manager
-    # Cleanup
-    Path(db_path).unlink(missing_ok=True)
+    # Cleanup (pytest borra el directorio temporal)
+    db_manager.cerrar()
 
 def test_crear_usuario(db):
     """Test: Crear usuario nuevo debe funcionar"""
@@ -60,7 +66,7 @@ def test_registrar_transaccion(db):
         username="juan",
         cuenta_origen="ES1234",
         cuenta_destino="ES5678",
-        cantidad=100.50,
+        cantidad_cents=10050,
         mac_verificado=True
     )
     
@@ -69,4 +75,186 @@ def test_registrar_transaccion(db):
     # Verificar que se guardó
     transacciones = db.obtener_transacciones_usuario("juan")
     assert len(transacciones) == 1
-    assert transacciones[0]['cantidad'] == 100.50
\ No newline at end of file
+    assert transacciones[0]['cantidad_cents'] == 10050
+    assert db.contar_transacciones("juan", 10050) == 1
+    assert db.contar_transacciones("juan", 10000) == 0
+
+
+def test_nonce_concurrente_solo_una_vez(db):
+    """Test: Con varios hilos a la vez, el NONCE solo se acepta una vez"""
+    nonce = b"nonce_concurrente_90123456789012"
+    
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        resultados = list(pool.map(lambda _: db.validar_nonce(nonce), range(8)))
+    
+    assert resultados.count(True) == 1
+
+def test_limpiar_nonces_expirados(db):
+    """Test: Solo se eliminan los NONCEs caducados, en varios lotes"""
+    for i in range(5):
+        db.validar_nonce(f"nonce_caducado_{i}".encode().ljust(32, b"0"), duracion_minutos=-1)
+    db.validar_nonce(b"nonce_vigente_123456789012345678")
+    
+    eliminados = db.limpiar_nonces_expirados(tam_lote=2)
+    
+    assert eliminados == 5
+    assert db.validar_nonce(b"nonce_vigente_123456789012345678") is False
+
+def test_login_usuario_inexistente_verifica_hash(db, monkeypatch):
+    """Test: El login de un usuario inexistente también verifica un hash Argon2"""
+    auth = autenticacion.Autenticacion(db)
+    llamadas = []
+    monkeypatch.setattr(autenticacion, "verificar_password",
+                        lambda h, p: llamadas.append(h) or False)
+    
+    exito, msg = auth.login("no_existe", "Cualquier_pass1!")
+    
+    assert exito is False
+    assert msg == "Credenciales incorrectas"
+    assert llamadas == [auth._hash_ficticio]
+
+def test_login_actualiza_hash_con_parametros_antiguos(db):
+    """Test: Un login correcto rehashea las contraseñas con parámetros antiguos"""
+    hash_antiguo = PasswordHasher(time_cost=1, memory_cost=8192, parallelism=1).hash("Antigua_pass1!")
+    db.crear_usuario("juan", hash_antiguo)
+    
+    exito, _ = Autenticacion(db).login("juan", "Antigua_pass1!")
+    
+    hash_nuevo = db.obtener_password_hash("juan")
+    assert exito is True
+    assert hash_nuevo != hash_antiguo
+    assert not necesita_rehash(hash_nuevo)
+
+def test_transacciones_paginadas(db):
+    """Test: limite/desplazamiento devuelven páginas de transacciones"""
+    db.crear_usuario("juan", hashear_password("pass123"))
+    for i in range(5):
+        db.registrar_transaccion("juan", "ES1234", "ES5678", i * 100)
+    
+    pagina = db.obtener_transacciones_usuario("juan", limite=2, desplazamiento=1)
+    
+    assert len(pagina) == 2
+    # Todas en el mismo segundo: el orden lo decide id (más reciente primero)
+    assert [t["cantidad_cents"] for t in pagina] == [300, 200]
+    assert len(db.obtener_transacciones_usuario("juan")) == 5
+    assert set(pagina[0]) == {"id", "cuenta_origen", "cuenta_destino", "cantidad_cents", "timestamp"}
+
+def test_login_repetido_usa_cache(db, monkeypatch):
+    """Test: Un segundo login correcto no repite Argon2; uno incorrecto sí"""
+    db.crear_usuario("juan", hashear_password("Correcta_pass1!"))
+    auth = autenticacion.Autenticacion(db)
+    assert auth.login("juan", "Correcta_pass1!")[0] is True
+    
+    llamadas = []
+    original = autenticacion.verificar_password
+    monkeypatch.setattr(autenticacion, "verificar_password",
+                        lambda h, p: llamadas.append(p) or original(h, p))
+    
+    assert auth.login("juan", "Correcta_pass1!")[0] is True
+    assert llamadas == []
+    assert auth.login("juan", "Incorrecta_pass1!")[0] is False
+    assert llamadas == ["Incorrecta_pass1!"]
+
+def test_cache_login_no_acepta_password_antigua(db):
+    """Test: Si el hash cambia o el usuario desaparece, la caché ya no vale"""
+    db.crear_usuario("juan", hashear_password("Antigua_pass1!"))
+    auth = Autenticacion(db)
+    assert auth.login("juan", "Antigua_pass1!")[0] is True
+    
+    # Contraseña cambiada fuera de Autenticacion (otro proceso, script...)
+    db.actualizar_password_hash("juan", hashear_password("Nueva_pass1!"))
+    assert auth.login("juan", "Antigua_pass1!")[0] is False
+    assert auth.login("juan", "Nueva_pass1!")[0] is True
+    
+    # Usuario borrado con un login aún en caché
+    with db.get_connection() as conn:
+        conn.execute("DELETE FROM usuarios WHERE username = ?", ("juan",))
+    assert auth.login("juan", "Nueva_pass1!")[0] is False
+
+def test_migracion_cantidad_a_centimos(tmp_path):
+    """Test: Una BD con cantidad REAL (esquema 1) se migra a céntimos"""
+    db_path = tmp_path / "v1.sqlite"
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE usuarios (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE transacciones (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL, cuenta_origen TEXT NOT NULL,
+            cuenta_destino TEXT NOT NULL, cantidad REAL NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            mac_verificado BOOLEAN DEFAULT TRUE);
+        INSERT INTO usuarios (username, password_hash) VALUES ('juan', 'x');
+        INSERT INTO transacciones (username, cuenta_origen, cuenta_destino, cantidad)
+            VALUES ('juan', 'ES1234', 'ES5678', 100.5);
+        PRAGMA user_version = 1;
+    """)
+    conn.close()
+    
+    db = DatabaseManager(str(db_path))
+    
+    transacciones = db.obtener_transacciones_usuario("juan")
+    assert [tx['cantidad_cents'] for tx in transacciones] == [10050]
+    db.cerrar()
+
+def test_migracion_nonces_without_rowid(tmp_path):
+    """Test: Una BD con nonces con rowid (esquema 2) se migra a WITHOUT ROWID"""
+    db_path = tmp_path / "v2.sqlite"
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE usuarios (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE transacciones (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL, cuenta_origen TEXT NOT NULL,
+            cuenta_destino TEXT NOT NULL, cantidad_cents INTEGER NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            mac_verificado BOOLEAN DEFAULT TRUE);
+        CREATE TABLE nonces (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            valor BLOB UNIQUE NOT NULL, expira TIMESTAMP NOT NULL,
+            usado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE INDEX idx_nonce_expira ON nonces(expira);
+        PRAGMA user_version = 2;
+    """)
+    conn.execute("INSERT INTO nonces (valor, expira) VALUES (?, ?)",
+                 (b"nonce_antiguo", int(time.time()) + 300))
+    conn.commit()
+    conn.close()
+    
+    db = DatabaseManager(str(db_path))
+    
+    with db.get_connection() as conn:
+        (sql,) = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'nonces'").fetchone()
+        indices = {fila['name'] for fila in conn.execute("PRAGMA index_list(nonces)")}
+    assert "WITHOUT ROWID" in sql
+    assert "idx_nonce_expira" in indices
+    # El NONCE registrado antes de migrar sigue contando como usado
+    assert db.validar_nonce(b"nonce_antiguo") is False
+    db.cerrar()
+
+
+def test_migracion_expira_iso_a_epoch(tmp_path):
+    """Test: Los NONCEs con expira en texto ISO (esquema 2) se pasan a epoch y se limpian"""
+    db_path = tmp_path / "v2_iso.sqlite"
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE nonces (valor BLOB PRIMARY KEY, expira TIMESTAMP NOT NULL,
+            usado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP) WITHOUT ROWID;
+        PRAGMA user_version = 2;
+    """)
+    # Formato que escribía validar_nonce antes del epoch entero
+    conn.executemany("INSERT INTO nonces (valor, expira) VALUES (?, ?)", [
+        (b"nonce_caducado", (datetime.now() - timedelta(minutes=10)).isoformat()),
+        (b"nonce_vigente", (datetime.now() + timedelta(minutes=5)).isoformat()),
+    ])
+    conn.commit()
+    conn.close()
+    
+    db = DatabaseManager(str(db_path))
+    
+    with db.get_connection() as conn:
+        tipos = {fila[0] for fila in conn.execute("SELECT typeof(expira) FROM nonces")}
+    assert tipos == {"integer"}
+    assert db.limpiar_nonces_expirados() == 1
+    assert db.validar_nonce(b"nonce_vigente") is False
+    db.cerrar()
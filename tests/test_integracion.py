@@ -3,84 +3,69 @@
 Tests de integración end-to-end
 Prueba el flujo completo: cliente → servidor → base de datos
 """
-import json
-import pytest
-import threading
-import time
 import socket
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
 
-from server.server import ServidorBancario
 from client.communicacion import ClienteSocket
-from common.config import Config
-from common.protocolo import Mensaje
-from unittest.mock import Mock, patch
 from client.client_cli import ClienteCLI
-from datetime import datetime, timedelta
+from common.config import Config
+from common.protocolo import Mensaje, desempaquetar_respuesta
+from common.constantes import FORMATO_JSON, MAX_ARGON2_LOTE
 
 # ════════════════════════════════════════════════════════
 # FIXTURES
 # ════════════════════════════════════════════════════════
 
 @pytest.fixture(scope="module")
-def servidor_test():
+def cliente_compartido(servidor_test):
     """
-    Fixture: Servidor de prueba con logging
-    """
-    import logging
-    from pathlib import Path
-    
-    # Crear directorio de logs
-    Path("logs").mkdir(exist_ok=True)
-    
-    # Configurar logging ANTES de iniciar el servidor
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            # Log a archivo (para evidencias)
-            logging.FileHandler('logs/test_servidor.log', encoding='utf-8'),
-            # Log a consola (para ver en tiempo real)
-            logging.StreamHandler()
-        ],
-        force=True  # Sobrescribir configuración anterior
-    )
-    # Configurar servidor de prueba en puerto diferente
-    servidor = ServidorBancario(host="127.0.0.1", port=5001)
-    
-    # Iniciar en thread separado (daemon)
-    thread = threading.Thread(target=servidor.iniciar, daemon=True)
-    thread.start()
-    
-    # Esperar a que el servidor esté listo
-    time.sleep(2)
+    Fixture: Una conexión persistente para todo el módulo
     
-    # Verificar que el servidor está escuchando
-    max_intentos = 5
-    for i in range(max_intentos):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(("127.0.0.1", 5001))
-            s.close()
-            break
-        except ConnectionRefusedError:
-            if i == max_intentos - 1:
-                pytest.fail("Servidor no se inició correctamente")
-            time.sleep(1)
-    
-    print("\n[TEST] Servidor de prueba iniciado en puerto 5001")
-    
-    yield servidor
+    Para los tests que no dependen del ciclo de vida de la conexión;
+    los que sí (replay, MAC, reconexión, fuerza bruta) abren la suya
+    """
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
+    assert cliente.conectar(), "No se pudo conectar al servidor"
+    yield cliente
+    cliente.desconectar()
+
+
+@pytest.fixture
+def crear_mensaje():
+    """Fixture: Fábrica de Mensaje(tipo, datos) a partir de argumentos con nombre"""
+    def _crear(tipo: str, **datos) -> Mensaje:
+        return Mensaje(tipo=tipo, datos=datos)
+    return _crear
+
+
+@pytest.fixture(scope="session")
+def paquete_replay(usuarios_pool):
+    """
+    Fixture: Transferencia de 100 EUR ya empaquetada (MAC + NONCE) para un
+    usuario del pool: el "paquete capturado" del test de replay
     
-    # Cleanup: Detener servidor
-    servidor.detener()
-    print("\n[TEST] Servidor de prueba detenido")
+    Returns:
+        Tuple[str, bytes]: (username, paquete)
+    """
+    username, _ = usuarios_pool.pop()
+    msg_transaccion = Mensaje(
+        tipo=Mensaje.TRANSACCION,
+        datos={
+            "username": username,
+            "cuenta_origen": "ES1234567890123456789012",
+            "cuenta_destino": "ES9876543210987654321098",
+            "cantidad": 100.00
+        }
+    )
+    return username, msg_transaccion.empaquetar(Config.get_shared_key())
 
 
 @pytest.fixture
-def cliente_test():
+def cliente_test(servidor_test):
     """Fixture: Cliente de prueba"""
-    cliente = ClienteSocket("127.0.0.1", 5001)
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
     yield cliente
     # Cleanup
     try:
@@ -93,24 +78,24 @@ def cliente_test():
 # TESTS DE FLUJO COMPLETO
 # ════════════════════════════════════════════════════════
 
-def test_flujo_completo_registro_login_transaccion(servidor_test):
+def test_flujo_completo_registro_login_transaccion(cliente_compartido, nombre_unico):
     """
     Test E2E: Flujo completo de un usuario
     1. Registro
     2. Login
     3. Transacción
     4. Otra transacción
+    
+    Los pasos van en un único enviar_batch: el servidor los atiende en
+    orden sobre la misma conexión y todo cuesta un solo viaje de ida y vuelta
     """
     clave = Config.get_shared_key()
-    username_test = f"test_user_{int(time.time())}"
+    username_test = nombre_unico("test_user")
     
     # ═══════════════════════════════════════════════════════
     # PASO 1: REGISTRO
     # ═══════════════════════════════════════════════════════
     
-    cliente = ClienteSocket("127.0.0.1", 5001)
-    assert cliente.conectar(), "No se pudo conectar al servidor"
-    
     msg_registro = Mensaje(
         tipo=Mensaje.REGISTRO,
         datos={
@@ -118,37 +103,10 @@ def test_flujo_completo_registro_login_transaccion(servidor_test):
             "password": "Correct_pass1!"
         }
     )
-    paquete = msg_registro.empaquetar(clave)
-    respuesta = cliente.enviar_y_recibir(paquete)
-    
-    assert respuesta is not None, "No se recibió respuesta del servidor"
-    assert respuesta["status"] == "ok", f"Registro falló: {respuesta.get('mensaje')}"
-    print(f"[TEST] ✅ Registro exitoso: {username_test}")
-    
-    cliente.desconectar()
     
     # ═══════════════════════════════════════════════════════
-    # PASO 2: LOGIN INCORRECTO - CORRECTO
+    # PASO 2: LOGIN (los casos correcto/incorrecto: test_login_casos)
     # ═══════════════════════════════════════════════════════
-    cliente.conectar()
-    
-    msg_login = Mensaje(
-        tipo=Mensaje.LOGIN,
-        datos={
-            "username": username_test,
-            "password": "PASSWORD_INCORRECTA"
-        }
-    )
-    paquete = msg_login.empaquetar(clave)
-    respuesta = cliente.enviar_y_recibir(paquete)
-    
-    assert respuesta is not None
-    assert respuesta["status"] == "error", "Debería rechazar credenciales incorrectas"
-    print(f"[TEST] ✅ Login rechazado correctamente")
-    
-    cliente.desconectar()
-    
-    cliente.conectar()
     
     msg_login = Mensaje(
         tipo=Mensaje.LOGIN,
@@ -157,21 +115,11 @@ def test_flujo_completo_registro_login_transaccion(servidor_test):
             "password": "Correct_pass1!"
         }
     )
-    paquete = msg_login.empaquetar(clave)
-    respuesta = cliente.enviar_y_recibir(paquete)
-    
-    assert respuesta is not None
-    assert respuesta["status"] == "ok", f"Login falló: {respuesta.get('mensaje')}"
-    print(f"[TEST] ✅ Login exitoso")
-    
-    cliente.desconectar()
     
     # ═══════════════════════════════════════════════════════
     # PASO 3: TRANSACCIÓN 1
     # ═══════════════════════════════════════════════════════
     
-    cliente.conectar()
-    
     msg_transaccion = Mensaje(
         tipo=Mensaje.TRANSACCION,
         datos={
@@ -181,21 +129,11 @@ def test_flujo_completo_registro_login_transaccion(servidor_test):
             "cantidad": 100.50
         }
     )
-    paquete = msg_transaccion.empaquetar(clave)
-    respuesta = cliente.enviar_y_recibir(paquete)
-    
-    assert respuesta is not None
-    assert respuesta["status"] == "ok", f"Transacción falló: {respuesta.get('mensaje')}"
-    print(f"[TEST] ✅ Transacción 1 exitosa: 100.50 EUR")
-    
-    cliente.desconectar()
     
     # ═══════════════════════════════════════════════════════
     # PASO 4: TRANSACCIÓN 2
     # ═══════════════════════════════════════════════════════
     
-    cliente.conectar()
-    
     msg_transaccion2 = Mensaje(
         tipo=Mensaje.TRANSACCION,
         datos={
@@ -205,156 +143,326 @@ def test_flujo_completo_registro_login_transaccion(servidor_test):
             "cantidad": 250.75
         }
     )
-    paquete = msg_transaccion2.empaquetar(clave)
-    respuesta = cliente.enviar_y_recibir(paquete)
     
-    assert respuesta is not None
-    assert respuesta["status"] == "ok"
+    mensajes = [msg_registro, msg_login, msg_transaccion, msg_transaccion2]
+    respuestas = cliente_compartido.enviar_batch([m.empaquetar(clave) for m in mensajes])
+    
+    assert len(respuestas) == len(mensajes), "No se recibieron todas las respuestas"
+    assert all(r is not None for r in respuestas), "No se recibió respuesta del servidor"
+    r_registro, r_login, r_tx1, r_tx2 = respuestas
+    
+    assert r_registro["status"] == "ok", f"Registro falló: {r_registro.get('mensaje')}"
+    print(f"[TEST] ✅ Registro exitoso: {username_test}")
+    
+    assert r_login["status"] == "ok", f"Login falló: {r_login.get('mensaje')}"
+    print(f"[TEST] ✅ Login exitoso")
+    
+    assert r_tx1["status"] == "ok", f"Transacción falló: {r_tx1.get('mensaje')}"
+    print(f"[TEST] ✅ Transacción 1 exitosa: 100.50 EUR")
+    
+    assert r_tx2["status"] == "ok"
     print(f"[TEST] ✅ Transacción 2 exitosa: 250.75 EUR")
+
+
+@pytest.mark.parametrize("password_correcta,status_esperado", [
+    (False, "error"),
+    (True, "ok"),
+], ids=["password_incorrecta", "password_correcta"])
+def test_login_casos(cliente_compartido, usuario_registrado, crear_mensaje,
+                     password_correcta, status_esperado):
+    """Test: Login de un usuario registrado con contraseña incorrecta y correcta"""
+    clave = Config.get_shared_key()
+    username_test, password_test = usuario_registrado
+    password = password_test if password_correcta else "PASSWORD_INCORRECTA"
     
-    cliente.desconectar()
+    msg_login = crear_mensaje(Mensaje.LOGIN, username=username_test, password=password)
+    respuesta = cliente_compartido.enviar_y_recibir(msg_login.empaquetar(clave))
+    
+    assert respuesta is not None
+    assert respuesta["status"] == status_esperado, respuesta.get("mensaje")
+    print(f"[TEST] ✅ Login con password_correcta={password_correcta}: {status_esperado}")
 
 
-def test_login_con_credenciales_incorrectas(servidor_test):
+def test_login_con_credenciales_incorrectas(cliente_compartido, crear_mensaje):
     """Test: Login con contraseña incorrecta debe fallar"""
     clave = Config.get_shared_key()
     
-    cliente = ClienteSocket("127.0.0.1", 5001)
-    cliente.conectar()
+    cliente = cliente_compartido
     
-    msg_login = Mensaje(
-        tipo=Mensaje.LOGIN,
-        datos={
-            "username": "usuario_inexistente",
-            "password": "password_incorrecta"
-        }
-    )
+    msg_login = crear_mensaje(Mensaje.LOGIN, username="usuario_inexistente", password="password_incorrecta")
     paquete = msg_login.empaquetar(clave)
     respuesta = cliente.enviar_y_recibir(paquete)
     
     assert respuesta is not None
     assert respuesta["status"] == "error", "Debería rechazar credenciales incorrectas"
     print(f"[TEST] ✅ Login rechazado correctamente")
-    
-    cliente.desconectar()
 
 
-def test_registro_usuario_duplicado(servidor_test):
+def test_registro_usuario_duplicado(cliente_compartido, crear_mensaje, nombre_unico):
     """Test: No se puede registrar el mismo usuario dos veces"""
     clave = Config.get_shared_key()
-    username_test = f"test_dup_{int(time.time())}"
+    username_test = nombre_unico("test_dup")
     
     # Primer registro
-    cliente = ClienteSocket("127.0.0.1", 5001)
-    cliente.conectar()
+    cliente = cliente_compartido
     
-    msg_registro = Mensaje(
-        tipo=Mensaje.REGISTRO,
-        datos={
-            "username": username_test,
-            "password": "Correct_pass1"
-        }
-    )
+    msg_registro = crear_mensaje(Mensaje.REGISTRO, username=username_test, password="Correct_pass1")
     paquete = msg_registro.empaquetar(clave)
     respuesta1 = cliente.enviar_y_recibir(paquete)
     
     assert respuesta1["status"] == "ok"
-    cliente.desconectar()
     
     # Segundo registro (mismo usuario)
-    cliente.conectar()
     paquete = msg_registro.empaquetar(clave)
     respuesta2 = cliente.enviar_y_recibir(paquete)
     
     assert respuesta2["status"] == "error", "Debería rechazar usuario duplicado"
     assert "existe" in respuesta2["mensaje"].lower()
     print(f"[TEST] ✅ Usuario duplicado rechazado correctamente")
+
+
+def test_varias_peticiones_misma_conexion(servidor_test, usuario_registrado):
+    """Test: La conexión persistente atiende varias peticiones seguidas"""
+    clave = Config.get_shared_key()
+    username_test, password_test = usuario_registrado
+    
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
+    assert cliente.conectar()
+    socket_inicial = cliente.socket
+    
+    msg_login = Mensaje(
+        tipo=Mensaje.LOGIN,
+        datos={
+            "username": username_test,
+            "password": password_test
+        }
+    )
+    respuesta = cliente.enviar_y_recibir(msg_login.empaquetar(clave))
+    assert respuesta["status"] == "ok"
+    
+    msg_transaccion = Mensaje(
+        tipo=Mensaje.TRANSACCION,
+        datos={
+            "username": username_test,
+            "cuenta_origen": "ES1234567890",
+            "cuenta_destino": "ES0987654321",
+            "cantidad": 1.0
+        }
+    )
+    respuesta = cliente.enviar_y_recibir(msg_transaccion.empaquetar(clave))
+    assert respuesta["status"] == "ok"
+    
+    # No se ha abierto una conexión nueva
+    assert cliente.socket is socket_inicial
+    print(f"[TEST] ✅ Dos peticiones atendidas en la misma conexion")
     
     cliente.desconectar()
 
 
-# ════════════════════════════════════════════════════════
-# TESTS DE SEGURIDAD
-# ════════════════════════════════════════════════════════
+def test_envio_por_lotes(cliente_compartido, nombre_unico):
+    """Test: Varias peticiones en un solo envío reciben respuestas en orden"""
+    clave = Config.get_shared_key()
+    username_test = nombre_unico("test_batch")
+    
+    mensajes = [
+        Mensaje(Mensaje.REGISTRO, {"username": username_test, "password": "Correct_pass1!"}),
+        Mensaje(Mensaje.LOGIN, {"username": username_test, "password": "PASSWORD_INCORRECTA"}),
+        Mensaje(Mensaje.LOGIN, {"username": username_test, "password": "Correct_pass1!"}),
+        Mensaje(Mensaje.TRANSACCION, {
+            "username": username_test,
+            "cuenta_origen": "ES1234567890",
+            "cuenta_destino": "ES0987654321",
+            "cantidad": 10.0
+        }),
+    ]
+    
+    respuestas = cliente_compartido.enviar_batch([m.empaquetar(clave) for m in mensajes])
+    
+    assert [r["status"] for r in respuestas] == ["ok", "error", "ok", "ok"]
+    print(f"[TEST] ✅ Lote de {len(mensajes)} peticiones procesado en orden")
 
-# tests/test_integration.py
 
-def test_detectar_replay_attack_transaccion(servidor_test):
-    """
-    Test: Servidor detecta replay attack en transacción
+def test_mensaje_lote(cliente_compartido, nombre_unico):
+    """Test: Varias operaciones bajo un único MAC reciben una respuesta conjunta"""
+    clave = Config.get_shared_key()
+    username_test = nombre_unico("test_lote")
     
-    Escenario realista:
-    1. Usuario se registra y hace login
-    2. Usuario hace una transferencia legítima de 100 EUR
-    3. Atacante captura el paquete de la transacción
-    4. Atacante reenvía el MISMO paquete (replay attack)
-    5. Servidor debe RECHAZAR el segundo intento
+    lote = Mensaje.lote([
+        Mensaje(Mensaje.REGISTRO, {"username": username_test, "password": "Correct_pass1!"}),
+        Mensaje(Mensaje.LOGIN, {"username": username_test, "password": "PASSWORD_INCORRECTA"}),
+        Mensaje(Mensaje.LOTE, {"items": []}),
+        Mensaje(Mensaje.TRANSACCION, {
+            "username": username_test,
+            "cuenta_origen": "ES1234567890",
+            "cuenta_destino": "ES0987654321",
+            "cantidad": 5.0
+        }),
+    ])
     
-    Impacto: Sin protección anti-replay, el atacante podría
-    duplicar transacciones y robar dinero.
-    """
-    import time
+    respuesta = cliente_compartido.enviar_y_recibir(lote.empaquetar(clave))
+    
+    assert respuesta["status"] == "ok"
+    respuestas = respuesta["datos"]["respuestas"]
+    # El lote anidado se rechaza sin afectar al resto
+    assert [r["status"] for r in respuestas] == ["ok", "error", "error", "ok"]
+    print("[TEST] ✅ Lote procesado con un solo MAC")
+
+
+def test_lote_elementos_malformados_y_limite_argon2(cliente_compartido, nombre_unico):
+    """Test: Un elemento malformado o de más falla solo, sin cerrar la conexión"""
     clave = Config.get_shared_key()
-    username_test = f"test_replay_{int(time.time())}"
     
-    # ═══════════════════════════════════════════════════════════
-    # PREPARACIÓN: Registrar usuario
-    # ═══════════════════════════════════════════════════════════
+    logins = [
+        {"tipo": Mensaje.LOGIN, "datos": {"username": nombre_unico("test_lote_argon2"),
+                                          "password": "password_incorrecta"}}
+        for _ in range(MAX_ARGON2_LOTE + 1)
+    ]
+    lote = Mensaje(Mensaje.LOTE, {"items": [
+        {"tipo": Mensaje.LOGIN, "datos": "no_es_un_dict"},
+        {"tipo": ["no", "hashable"], "datos": {}},
+        "basura",
+        *logins,
+    ]})
     
-    cliente = ClienteSocket("127.0.0.1", 5001)
-    cliente.conectar()
+    respuesta = cliente_compartido.enviar_y_recibir(lote.empaquetar(clave))
     
-    msg_registro = Mensaje(
-        tipo=Mensaje.REGISTRO,
-        datos={
-            "username": username_test,
-            "password": "Correct_pass1"
-        }
+    assert respuesta["status"] == "ok"
+    mensajes = [r["mensaje"] for r in respuesta["datos"]["respuestas"]]
+    assert mensajes[:3] == ["Elemento del lote malformado"] * 3
+    # Los malformados no cuentan: el único rechazado es el login de más
+    assert not any("Demasiados" in m for m in mensajes[3:-1])
+    assert "Demasiados registros/logins" in mensajes[-1]
+    
+    # Datos que no son un dict: error, y la conexión sigue sirviendo
+    respuesta = cliente_compartido.enviar_y_recibir(
+        Mensaje(Mensaje.LOTE, ["no_es_un_dict"]).empaquetar(clave)
     )
-    paquete = msg_registro.empaquetar(clave)
-    respuesta = cliente.enviar_y_recibir(paquete)
-    assert respuesta["status"] == "ok", "Registro falló"
-    
-    cliente.desconectar()
+    assert respuesta["status"] == "error"
+    assert "malformado" in respuesta["mensaje"]
+    print("[TEST] ✅ Lote con elementos malformados procesado sin cerrar la conexion")
+
+
+def test_reconexion_si_servidor_cierra(servidor_test):
+    """Test: El cliente reconecta una vez si la conexión se perdió"""
+    clave = Config.get_shared_key()
     
-    # ═══════════════════════════════════════════════════════════
-    # PASO 1: Usuario hace LOGIN legítimo
-    # ═══════════════════════════════════════════════════════════
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
+    assert cliente.conectar()
     
-    cliente.conectar()
+    # Simular conexión caída: el socket local ya no sirve
+    cliente.socket.shutdown(socket.SHUT_RDWR)
     
     msg_login = Mensaje(
         tipo=Mensaje.LOGIN,
         datos={
-            "username": username_test,
-            "password": "Correct_pass1"
+            "username": "usuario_inexistente",
+            "password": "password_incorrecta"
         }
     )
-    paquete = msg_login.empaquetar(clave)
-    respuesta = cliente.enviar_y_recibir(paquete)
-    assert respuesta["status"] == "ok", "Login falló"
+    respuesta = cliente.enviar_y_recibir(msg_login.empaquetar(clave))
+    
+    assert respuesta is not None, "No reconectó tras perder la conexión"
+    assert respuesta["status"] == "error"
+    print(f"[TEST] ✅ Reconexion automatica tras perder la conexion")
     
     cliente.desconectar()
+
+
+@pytest.mark.parametrize("via", ["enviar_y_recibir", "enviar_mensajes"])
+def test_reconexion_tras_timeout_inactividad(servidor_test, monkeypatch, via):
+    """Test: El servidor cierra la conexión inactiva y el cliente reconecta sin error"""
+    monkeypatch.setattr(Config, "CLIENT_IDLE_TIMEOUT", 0.2)
+    clave = Config.get_shared_key()
+    
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
+    cli = ClienteCLI()
+    cli.socket_cliente = cliente
+    
+    def _enviar() -> list:
+        """Una petición sola, o dos en un envío (pipelining) desde el CLI"""
+        msg = Mensaje(Mensaje.LOGIN, {"username": "usuario_inexistente",
+                                      "password": "password_incorrecta"})
+        if via == "enviar_y_recibir":
+            return [cliente.enviar_y_recibir(msg.empaquetar(clave))]
+        return cli.enviar_mensajes([msg, msg])
+    
+    assert cliente.conectar()
+    assert all(r and r["status"] == "error" for r in _enviar())
+    socket_inicial = cliente.socket
+    
+    # Sin peticiones, el servidor cierra la conexión: el cliente lee EOF
+    socket_inicial.settimeout(5)
+    assert socket_inicial.recv(1, socket.MSG_PEEK) == b"", "El servidor no cerró la conexión inactiva"
+    
+    # La siguiente petición reconecta de forma transparente
+    respuestas = _enviar()
+    assert None not in respuestas, "No reconectó tras el timeout de inactividad"
+    assert all(r["status"] == "error" for r in respuestas)
+    assert cliente.socket is not socket_inicial
+    print(f"[TEST] ✅ Reconexion automatica tras el timeout de inactividad ({via})")
+    
+    cliente.desconectar()
+
+
+def test_enviar_batch_tras_timeout_inactividad(servidor_test, monkeypatch):
+    """Test: enviar_batch reconecta y reenvía si el servidor cerró la conexión inactiva"""
+    monkeypatch.setattr(Config, "CLIENT_IDLE_TIMEOUT", 0.2)
+    clave = Config.get_shared_key()
+    
+    def _paquetes():
+        return [
+            Mensaje(Mensaje.LOGIN, {"username": "usuario_inexistente",
+                                    "password": "password_incorrecta"}).empaquetar(clave)
+            for _ in range(2)
+        ]
+    
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
+    assert cliente.conectar()
+    assert [r["status"] for r in cliente.enviar_batch(_paquetes())] == ["error", "error"]
+    
+    # Esperar a que el servidor cierre la conexión inactiva
+    cliente.socket.settimeout(5)
+    assert cliente.socket.recv(1, socket.MSG_PEEK) == b""
+    cliente.socket.settimeout(None)
+    
+    # Varios lotes seguidos: el primero reconecta, los demás usan la nueva conexión
+    for _ in range(3):
+        respuestas = cliente.enviar_batch(_paquetes())
+        assert [r and r["status"] for r in respuestas] == ["error", "error"]
+    print(f"[TEST] ✅ enviar_batch reconecta tras el timeout de inactividad")
+    
+    cliente.desconectar()
+
+
+# ════════════════════════════════════════════════════════
+# TESTS DE SEGURIDAD
+# ════════════════════════════════════════════════════════
+
+# tests/test_integration.py
+
+def test_detectar_replay_attack_transaccion(servidor_test, paquete_replay, db_servidor):
+    """
+    Test: Servidor detecta replay attack en transacción
+    
+    Escenario realista:
+    1. Usuario registrado (del pool) hace una transferencia legítima de 100 EUR
+    2. Atacante captura el paquete de la transacción
+    3. Atacante reenvía el MISMO paquete (replay attack)
+    4. Servidor debe RECHAZAR el segundo intento
+    
+    Impacto: Sin protección anti-replay, el atacante podría
+    duplicar transacciones y robar dinero.
+    """
+    # 🎯 PAQUETE CAPTURADO (simula que el atacante lo intercepta)
+    username_test, paquete_transaccion = paquete_replay
     
     # ═══════════════════════════════════════════════════════════
-    # PASO 2: Usuario hace TRANSACCIÓN legítima (100 EUR)
+    # PASO 1: Usuario hace TRANSACCIÓN legítima (100 EUR)
     # ═══════════════════════════════════════════════════════════
     
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
     cliente.conectar()
     
-    msg_transaccion = Mensaje(
-        tipo=Mensaje.TRANSACCION,
-        datos={
-            "username": username_test,
-            "cuenta_origen": "ES1234567890123456789012",
-            "cuenta_destino": "ES9876543210987654321098",
-            "cantidad": 100.00
-        }
-    )
-    
-    # 🎯 CAPTURAR EL PAQUETE (simula que el atacante lo intercepta)
-    paquete_transaccion = msg_transaccion.empaquetar(clave)
-    
     # Enviar primera vez (transacción legítima)
     respuesta1 = cliente.enviar_y_recibir(paquete_transaccion)
     
@@ -368,7 +476,7 @@ def test_detectar_replay_attack_transaccion(servidor_test):
     cliente.desconectar()
     
     # ═══════════════════════════════════════════════════════════
-    # PASO 3: ATACANTE REENVÍA EL MISMO PAQUETE (Replay Attack)
+    # PASO 2: ATACANTE REENVÍA EL MISMO PAQUETE (Replay Attack)
     # ═══════════════════════════════════════════════════════════
     
     print(f"\n[TEST] 🚨 ATACANTE intenta replay attack...")
@@ -402,20 +510,11 @@ def test_detectar_replay_attack_transaccion(servidor_test):
     # VERIFICACIÓN ADICIONAL: Comprobar en BD
     # ═══════════════════════════════════════════════════════════
     
-    from server.database import DatabaseManager
-    db = DatabaseManager(Config.DB_PATH)
-    
-    # Obtener transacciones del usuario
-    transacciones = db.obtener_transacciones_usuario(username_test)
-    
     # Verificar que SOLO hay UNA transacción de 100 EUR
-    transacciones_100_eur = [
-        tx for tx in transacciones 
-        if tx['cantidad'] == 100.00
-    ]
+    transacciones_100_eur = db_servidor.contar_transacciones(username_test, 10000)
     
-    assert len(transacciones_100_eur) == 1, \
-        f" FALLO: Se registraron {len(transacciones_100_eur)} transacciones (debería ser 1)"
+    assert transacciones_100_eur == 1, \
+        f" FALLO: Se registraron {transacciones_100_eur} transacciones (debería ser 1)"
     
     print(f"\n[TEST]  Base de datos correcta: Solo 1 transacción registrada")
     print(f"        El replay NO se procesó")
@@ -427,7 +526,7 @@ def test_detectar_mac_invalido(servidor_test):
     """
     clave = Config.get_shared_key()
     
-    cliente = ClienteSocket("127.0.0.1", 5001)
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
     cliente.conectar()
     
     # Crear mensaje con MAC válido
@@ -438,24 +537,19 @@ def test_detectar_mac_invalido(servidor_test):
             "password": "pass"
         }
     )
-    mensaje_bytes, mac_valido, nonce = msg.serializar(clave)
+    mensaje_bytes, mac_valido, nonce = msg.serializar(clave, FORMATO_JSON)
     
     # Modificar el mensaje (simular ataque MiTM)
     mensaje_modificado = mensaje_bytes.replace(b"test", b"hack")
     
     # Empaquetar con mensaje modificado pero MAC original
-    import json
-    import base64
-    paquete_malicioso = json.dumps({
-        "mensaje": base64.b64encode(mensaje_modificado).decode('ascii'),
-        "mac": base64.b64encode(mac_valido).decode('ascii'),
-        "nonce": base64.b64encode(nonce).decode('ascii')
-    }).encode('utf-8')
+    # [formato u8][mac][nonce][mensaje]
+    paquete_malicioso = bytes([FORMATO_JSON]) + mac_valido + nonce + mensaje_modificado
     
     # Enviar mensaje modificado
-    cliente.socket.sendall(paquete_malicioso)
-    respuesta_bytes = cliente.socket.recv(4096)
-    respuesta = json.loads(respuesta_bytes.decode('utf-8'))
+    cliente.enviar(paquete_malicioso)
+    respuesta_bytes = cliente.recibir()
+    respuesta = desempaquetar_respuesta(respuesta_bytes)
     
     assert respuesta["status"] == "error"
     assert "MAC" in respuesta["mensaje"] or "integridad" in respuesta["mensaje"].lower()
@@ -472,15 +566,15 @@ def test_detectar_mac_invalido(servidor_test):
 
 def test_mensaje_malformado(servidor_test):
     """Test: Servidor maneja mensajes malformados sin crashear"""
-    cliente = ClienteSocket("127.0.0.1", 5001)
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
     cliente.conectar()
     
-    # Enviar basura
+    # Enviar basura (sin cabecera de longitud válida)
     cliente.socket.sendall(b"BASURA_NO_JSON_12345")
     
     try:
-        respuesta_bytes = cliente.socket.recv(4096)
-        respuesta = json.loads(respuesta_bytes.decode('utf-8'))
+        respuesta_bytes = cliente.recibir()
+        respuesta = desempaquetar_respuesta(respuesta_bytes)
         
         assert respuesta["status"] == "error"
         assert "malformado" in respuesta["mensaje"].lower()
@@ -492,21 +586,33 @@ def test_mensaje_malformado(servidor_test):
     cliente.desconectar()
 
 
+def test_conexion_rechazada_si_servidor_lleno(servidor_test, monkeypatch):
+    """Test: Por encima de MAX_CONEXIONES se responde "Servidor ocupado" sin esperar en cola"""
+    monkeypatch.setattr(Config, "MAX_CONEXIONES", 0)
+    
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
+    assert cliente.conectar()
+    
+    # El servidor responde y cierra sin que el cliente llegue a enviar nada
+    respuesta = desempaquetar_respuesta(cliente.recibir())
+    assert respuesta["status"] == "error"
+    assert "ocupado" in respuesta["mensaje"].lower()
+    assert cliente.recibir() is None
+    
+    cliente.desconectar()
+    print(f"[TEST] ✅ Conexion rechazada con el servidor lleno")
+
+
 # ════════════════════════════════════════════════════════
 # TEST DE PERSISTENCIA
 # ════════════════════════════════════════════════════════
 
-def test_datos_persisten_en_base_de_datos(servidor_test):
+def test_datos_persisten_en_base_de_datos(cliente_compartido, db_servidor, nombre_unico):
     """Test: Los datos se guardan correctamente en la BD"""
-    from server.database import DatabaseManager
-    
     clave = Config.get_shared_key()
-    username_test = f"test_persist_{int(time.time())}"
+    username_test = nombre_unico("test_persist")
     
     # Registrar usuario
-    cliente = ClienteSocket("127.0.0.1", 5001)
-    cliente.conectar()
-    
     msg_registro = Mensaje(
         tipo=Mensaje.REGISTRO,
         datos={
@@ -515,14 +621,12 @@ def test_datos_persisten_en_base_de_datos(servidor_test):
         }
     )
     paquete = msg_registro.empaquetar(clave)
-    cliente.enviar_y_recibir(paquete)
-    cliente.desconectar()
+    cliente_compartido.enviar_y_recibir(paquete)
     
-    # Verificar en BD directamente
-    db = DatabaseManager(Config.DB_PATH)
-    assert db.usuario_existe(username_test), "Usuario no se guardó en BD"
+    # Verificar en BD directamente (desde otra conexión que la del servidor)
+    assert db_servidor.usuario_existe(username_test), "Usuario no se guardó en BD"
     
-    hash_bd = db.obtener_password_hash(username_test)
+    hash_bd = db_servidor.obtener_password_hash(username_test)
     assert hash_bd is not None
     assert hash_bd.startswith("$argon2"), "Password no se hasheó con Argon2"
     
@@ -532,90 +636,75 @@ def test_datos_persisten_en_base_de_datos(servidor_test):
 # TEST ATAQUE DE FUERZA BRUTA EN LOGIN
 # ════════════════════════════════════════════════════════
 
-def test_servidor_bloquea_fuerza_bruta_login(servidor_test):
+def test_servidor_bloquea_fuerza_bruta_login(servidor_test, usuario_registrado, crear_mensaje):
     """
     Test: SERVIDOR bloquea intentos de fuerza bruta en login
     
     Verifica que después de X intentos fallidos, el servidor
     bloquea el usuario temporalmente.
     """
-    import time
     clave = Config.get_shared_key()
-    username_test = f"test_brute_{int(time.time())}"
-    
-    # ═══════════════════════════════════════════════════════
-    # PREPARACIÓN: Registrar usuario
-    # ═══════════════════════════════════════════════════════
-    
-    cliente = ClienteSocket("127.0.0.1", 5001)
-    cliente.conectar()
-    
-    msg_registro = Mensaje(
-        tipo=Mensaje.REGISTRO,
-        datos={
-            "username": username_test,
-            "password": "Correct_Pass123!"
-        }
-    )
-    paquete = msg_registro.empaquetar(clave)
-    respuesta = cliente.enviar_y_recibir(paquete)
-    assert respuesta["status"] == "ok", "Registro falló"
-    
-    cliente.desconectar()
-    
-    print(f"\n[TEST] Usuario '{username_test}' registrado correctamente")
+    # Usuario propio del pool: bloquearlo no afecta a otros tests
+    username_test, password_test = usuario_registrado
     
     # ═══════════════════════════════════════════════════════
     # ATAQUE: Intentar login con contraseña incorrecta 5 veces
     # ═══════════════════════════════════════════════════════
     
-    msg_login = Mensaje(
-        tipo=Mensaje.LOGIN,
-        datos={
-            "username": username_test,
-            "password": "Wrong_Password_123!"  # ← Incorrecta
-        }
+    msg_login = crear_mensaje(
+        Mensaje.LOGIN,
+        username=username_test,
+        password="Wrong_Password_123!",  # ← Incorrecta
     )
     
-    intentos_rechazados = 0
+    # Cada intento necesita su propio NONCE (anti-replay): se empaquetan
+    # todos antes de lanzarlos
+    paquetes = [msg_login.empaquetar(clave) for _ in range(6)]  # límite es 5
     
-    for i in range(6):  # Intentar 6 veces (límite es 5)
+    def intentar(paquete):
         # Nueva conexión por cada intento
-        cliente = ClienteSocket("127.0.0.1", 5001)
+        cliente = ClienteSocket(servidor_test.host, servidor_test.port)
         cliente.conectar()
-        
-        paquete = msg_login.empaquetar(clave)
         respuesta = cliente.enviar_y_recibir(paquete)
-        
         cliente.desconectar()
-        
+        return respuesta
+    
+    # Los 6 intentos a la vez: el servidor comprueba el bloqueo y reserva el
+    # intento en la misma sección crítica, así que como mucho
+    # MAX_INTENTOS_LOGIN llegan a verificar la contraseña
+    with ThreadPoolExecutor(max_workers=len(paquetes)) as pool:
+        respuestas = list(pool.map(intentar, paquetes))
+    
+    for i, respuesta in enumerate(respuestas):
         print(f"[TEST] Intento #{i+1}: {respuesta['mensaje']}")
-        
         assert respuesta["status"] == "error"
-        
-        if "bloqueado" in respuesta["mensaje"].lower():
-            print(f"[TEST] ✅ Usuario bloqueado en intento #{i+1}")
-            intentos_rechazados = i + 1
-            break
     
-    # Verificar que se bloqueó
-    assert intentos_rechazados > 0, "El servidor NO bloqueó después de intentos fallidos"
-    assert intentos_rechazados <= 6, "Debería haberse bloqueado en 6 intentos o menos"
+    # Verificar que se bloqueó: los rechazados sin comprobar credenciales
+    # empiezan por "Usuario bloqueado"; los comprobados traen el fallo de login
+    limite = servidor_test.MAX_INTENTOS_LOGIN
+    rechazados = [r for r in respuestas if r["mensaje"].startswith("Usuario bloqueado")]
+    comprobados = [r for r in respuestas if r not in rechazados]
+    assert len(comprobados) == limite, \
+        f"{len(comprobados)} intentos llegaron a verificar la contraseña (máximo {limite})"
+    assert len(rechazados) == len(respuestas) - limite, "El servidor NO bloqueó los intentos sobrantes"
+    # De los comprobados, uno (el que alcanza el límite) anuncia el bloqueo
+    # y el resto informa de los intentos restantes
+    assert sum("Usuario bloqueado por" in r["mensaje"] for r in comprobados) == 1
+    assert sum("Intentos restantes" in r["mensaje"] for r in comprobados) == limite - 1
+    print(f"[TEST] ✅ Usuario bloqueado tras {len(respuestas)} intentos simultáneos")
     
     # ═══════════════════════════════════════════════════════
     # VERIFICAR: Siguiente intento también es rechazado
     # ═══════════════════════════════════════════════════════
     
-    cliente = ClienteSocket("127.0.0.1", 5001)
+    cliente = ClienteSocket(servidor_test.host, servidor_test.port)
     cliente.conectar()
     
     # Intentar con la CONTRASEÑA CORRECTA (debería seguir bloqueado)
-    msg_login_correcto = Mensaje(
-        tipo=Mensaje.LOGIN,
-        datos={
-            "username": username_test,
-            "password": "Correct_Pass123!"  # ← CORRECTA
-        }
+    msg_login_correcto = crear_mensaje(
+        Mensaje.LOGIN,
+        username=username_test,
+        password=password_test,  # ← CORRECTA
     )
     paquete = msg_login_correcto.empaquetar(clave)
     respuesta = cliente.enviar_y_recibir(paquete)
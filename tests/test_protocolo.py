@@ -0,0 +1,57 @@
+import pytest
+from common.protocolo import Mensaje, MensajeRespuesta, FORMATO_POR_DEFECTO, desempaquetar_respuesta
+from common.constantes import FORMATO_JSON, FORMATO_MSGPACK
+from common.crypto__utils import verificar_mac
+
+CLAVE = b"clave_de_prueba_32_bytes_long!@#"
+
+@pytest.mark.parametrize("formato", [FORMATO_JSON, FORMATO_MSGPACK])
+def test_empaquetar_desempaquetar(formato):
+    """Test: Un mensaje empaquetado se recupera intacto en cualquier formato"""
+    if formato == FORMATO_MSGPACK:
+        pytest.importorskip("msgpack")
+    
+    msg = Mensaje(
+        tipo=Mensaje.TRANSACCION,
+        datos={"username": "juan", "cantidad": 100.50}
+    )
+    paquete = msg.empaquetar(CLAVE, formato)
+    
+    formato_recibido, mensaje_bytes, mac, nonce = Mensaje.desempaquetar(paquete)
+    
+    assert formato_recibido == formato
+    assert verificar_mac(CLAVE, mensaje_bytes, nonce, mac)
+    
+    recuperado = Mensaje.desde_bytes(mensaje_bytes, formato_recibido)
+    assert recuperado.tipo == Mensaje.TRANSACCION
+    assert recuperado.datos == msg.datos
+
+def test_formato_desconocido():
+    """Test: Un paquete con formato desconocido se rechaza"""
+    with pytest.raises(ValueError):
+        Mensaje.desempaquetar(bytes([99]) + bytes(64) + b"{}")
+
+def test_paquete_demasiado_corto():
+    """Test: Un paquete sin MAC/NONCE completos se rechaza"""
+    with pytest.raises(ValueError):
+        Mensaje.desempaquetar(bytes([FORMATO_JSON]) + b"{}")
+
+def test_formato_por_defecto():
+    """Test: Se usa msgpack si está instalado"""
+    try:
+        import msgpack
+        assert FORMATO_POR_DEFECTO == FORMATO_MSGPACK
+    except ImportError:
+        assert FORMATO_POR_DEFECTO == FORMATO_JSON
+
+@pytest.mark.parametrize("formato", [FORMATO_JSON, FORMATO_MSGPACK])
+def test_respuesta_ida_y_vuelta(formato):
+    """Test: La respuesta viaja en el formato pedido y se recupera intacta"""
+    if formato == FORMATO_MSGPACK:
+        pytest.importorskip("msgpack")
+    
+    resp = MensajeRespuesta("ok", "Transferencia realizada: 5.00 EUR", {"id": 7})
+    datos = resp.empaquetar(formato)
+    
+    assert datos[0] == formato
+    assert desempaquetar_respuesta(datos) == resp.a_dict()